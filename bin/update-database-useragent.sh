@@ -24,11 +24,14 @@ SLICER_DOWNLOAD_STATS_DB_FILE="${ROOT_DIR}/var/download-stats.sqlite"
 SITE_LOG_DIR=${SITE_LOG_DIR:-$(realpath -m "${ROOT_DIR}/../logs/sites/slicer_download_org")}
 mkdir -p ${SITE_LOG_DIR}
 
+JOBS=${JOBS:-$(nproc)}
+
 # Display summary
 echo
 echo "[slicer_parselogs] Using this config"
 echo "  SLICER_DOWNLOAD_SERVER_API       : ${SLICER_DOWNLOAD_SERVER_API}"
 echo "  SLICER_DOWNLOAD_STATS_DB_FILE    : ${SLICER_DOWNLOAD_STATS_DB_FILE}"
+echo "  JOBS                             : ${JOBS}"
 echo
 echo "[slicer_parselogs] Using these directories"
 echo "  ROOT_DIR       : ${ROOT_DIR}"
@@ -39,4 +42,5 @@ export PYTHONPATH=${ROOT_DIR}:${ROOT_DIR}/etc
 exec "${PYTHON_EXECUTABLE}" "${ROOT_DIR}/etc/slicer_parselogs" \
     --db ${SLICER_DOWNLOAD_STATS_DB_FILE} \
     --update-useragent-table \
+    --jobs ${JOBS} \
     $*
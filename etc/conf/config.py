@@ -6,5 +6,7 @@ from config_utils import toBool  # noqa: E402
 
 
 DB_FALLBACK = toBool(os.environ.get("SLICER_DOWNLOAD_DB_FALLBACK", False))
+DB_WATCH = toBool(os.environ.get("SLICER_DOWNLOAD_DB_WATCH", False))
+DB_WATCH_DEBOUNCE = float(os.environ.get("SLICER_DOWNLOAD_DB_WATCH_DEBOUNCE", 2.0))
 DEBUG = toBool(os.environ.get("SLICER_DOWNLOAD_DEBUG", False))
 TEMPLATES_AUTO_RELOAD = toBool(os.environ.get("SLICER_DOWNLOAD_TEMPLATES_AUTO_RELOAD", True))
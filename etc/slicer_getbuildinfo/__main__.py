@@ -1,14 +1,29 @@
 import argparse
+import datetime
 import json
-import requests
+import os
 import sqlite3
 import sys
+import tempfile
 
 from slicer_download import (
+    chunked,
+    decodeRecord,
+    decodeRecordText,
+    encodeRecord,
+    RECORD_ENCODINGS,
+    getRecordField,
     getServerAPI,
+    getVersion,
+    recordMatchesStability,
     ServerAPI,
-    getRecordsFromURL,
-    getServerAPIUrl
+    STABILITY_CHOICES,
+    getDeletedItemIdsFromURL,
+    getReleasesFromURL,
+    getServerAPIUrl,
+    getLatestRecordUpdatedDate,
+    iterRecordsFromURL,
+    ResponseCache
 )
 
 
@@ -16,12 +31,13 @@ def getRecordsFromDB(dbfile):
     """Get the records from a SQLite 3.0 database file.
 
     Returns a list of dictionaries where each dictionary contains the fields
-    and values of a record in the database.
+    and values of a record in the database. Compressed records are decoded
+    using :func:`slicer_download.decodeRecord`.
     """
     with sqlite3.connect(dbfile) as db:
         cursor = db.cursor()
         cursor.execute("select record from _")
-        return [json.loads(row[0]) for row in cursor.fetchall()]
+        return [decodeRecord(row[0]) for row in cursor.fetchall()]
 
 
 def midasRecordToDb(r):
@@ -30,14 +46,19 @@ def midasRecordToDb(r):
     Returns a list of fields in the order that they should be inserted into
     the database. The Midas fields include the id (``item_id``), the
     revision (``revision``), the checkout date (``checkoutdate``),
-    the build date (``date_creation``) and the entire record as a JSON string.
+    the build date (``date_creation``), the entire record as a JSON string,
+    the operating system (``os``), the architecture (``arch``) and a
+    ``None`` folder id.
     """
     try:
         return [int(r['item_id']),
                 int(r['revision']),
                 r['checkoutdate'],
                 r['date_creation'],
-                json.dumps(r)]
+                json.dumps(r),
+                r['os'],
+                r['arch'],
+                None]
     except ValueError:
         return None
 
@@ -48,13 +69,18 @@ def girderRecordToDb(r):
     Returns a list of fields in the order that they should be inserted
     into the database. The Girder fields include the id (``_id``), the
     revision (``meta.revision``), the checkout date (``created``), the
-    build date (``meta.build_date``) and the entire record as a JSON string.
+    build date (``meta.build_date``), the entire record as a JSON string,
+    the operating system (``meta.os``), the architecture (``meta.arch``)
+    and the folder id (``folderId``).
     """
     return [r['_id'],
             int(r['meta']['revision']),
             r['created'],
             r['meta']['build_date'],
-            json.dumps(r)]
+            json.dumps(r),
+            r['meta']['os'],
+            r['meta']['arch'],
+            r['folderId']]
 
 
 def recordToDb(r):
@@ -70,27 +96,399 @@ def recordToDb(r):
     }[getServerAPI()](r)
 
 
-def applicationPackageToIDs(records):
+def recordUpdatedDate(r):
+    """Return the date a record was last modified.
+
+    Only Girder records (see :const:`ServerAPI.Girder_v1`) are associated with
+    a modification date (``updated``), ``None`` is returned for Midas records.
+    """
+    if getServerAPI() == ServerAPI.Girder_v1:
+        return r['updated']
+    return None
+
+
+def getMetadata(db, key, default=None):
+    """Return value associated with ``key`` in the ``_meta`` table."""
+    row = db.execute("select value from _meta where key=?", (key, )).fetchone()
+    return row[0] if row else default
+
+
+def setMetadata(db, key, value):
+    """Associate ``value`` with ``key`` in the ``_meta`` table."""
+    db.execute("insert or replace into _meta(key, value) values(?, ?)", (key, value))
+
+
+def isFullSyncRequired(db, fullSyncIntervalDays):
+    """Return True if all records should be retrieved from the packages server.
+
+    A full synchronization is required if no high-water mark has been recorded, if the last
+    full synchronization is older than ``fullSyncIntervalDays`` or if the server API does
+    not support incremental retrieval (see :func:`slicer_download.iterRecordPages`).
+    """
+    if getServerAPI() != ServerAPI.Girder_v1:
+        return True
+    if getMetadata(db, "updated_high_water_mark") is None:
+        return True
+    lastFullSync = getMetadata(db, "last_full_sync")
+    if lastFullSync is None:
+        return True
+    elapsed = datetime.datetime.utcnow() - datetime.datetime.fromisoformat(lastFullSync)
+    return elapsed >= datetime.timedelta(days=fullSyncIntervalDays)
+
+
+def createRecordsTables(db):
+    """Create the records (``_``), metadata (``_meta``) and latest builds (``_latest``) tables
+    if they do not exist.
+
+    The ``record_sha256``, ``os``, ``arch`` and ``folder_id`` columns are added to records
+    tables created before they were introduced and initialized from the existing records.
+
+    Application packages are indexed by ``revision``, ``os`` and ``arch``.
+    """
+    primary_key_type = "INTEGER" if getServerAPI() == ServerAPI.Midas_v1 else "TEXT"
+    db.execute('''create table if not exists
+    _(item_id {primary_key_type} primary key,
+                revision INTEGER,
+                checkout_date TEXT,
+                build_date TEXT,
+                record TEXT,
+                record_sha256 TEXT,
+                os TEXT,
+                arch TEXT,
+                folder_id TEXT)'''.format(primary_key_type=primary_key_type))
+    db.execute('''create table if not exists
+    _meta(key TEXT primary key, value TEXT)''')
+    db.execute('''create table if not exists
+    _latest(os TEXT,
+            stability TEXT,
+            version_prefix TEXT,
+            item_id,
+            primary key(os, stability, version_prefix))''')
+
+    columns = [row[1] for row in db.execute("pragma table_info(_)")]
+    if "record_sha256" not in columns:
+        print("Adding 'record_sha256' column")
+        db.execute("alter table _ add column record_sha256 TEXT")
+        db.create_function(
+            "sha256", 1, lambda record: computeContentChecksum("SHA256", decodeRecordText(record).encode()))
+        db.execute("update _ set record_sha256 = sha256(record)")
+
+    if "os" not in columns:
+        print("Adding 'os', 'arch' and 'folder_id' columns")
+        for column in ("os", "arch", "folder_id"):
+            db.execute(f"alter table _ add column {column} TEXT")
+        rows = (recordToDb(decodeRecord(row[0])) for row in db.execute("select record from _").fetchall())
+        db.executemany(
+            "update _ set os=?, arch=?, folder_id=? where item_id=?",
+            [(row[5], row[6], row[7], row[0]) for row in rows if row])
+
+    db.execute("create index if not exists _package_idx on _(revision, os, arch)")
+
+
+def updateRecords(db, records, chunkSize):
+    """Insert new records and update the changed ones.
+
+    Records are converted using :func:`recordToDb` and processed in chunks of ``chunkSize``
+    records. The SHA256 checksum of each converted record is compared with the one stored in
+    the ``record_sha256`` column and only rows that are new or actually changed are written.
+
+    Records are stored using the encoding associated with the ``record_encoding`` metadata
+    (see :func:`slicer_download.encodeRecord`), checksums are computed before encoding.
+
+    Identifiers of all processed records are collected in the ``_fetched`` temporary table,
+    identifiers of the rows added or updated in the ``_changed`` temporary table, and the
+    ``updated_high_water_mark`` metadata is set to the most recent modification date
+    (see :func:`recordUpdatedDate`).
+
+    Returns a tuple ``(numberOfRecords, numberOfRowsAdded, numberOfRowsUpdated)``.
+    """
+    for table in ("_fetched", "_changed"):
+        db.execute(f"create temp table if not exists {table}(item_id primary key)")
+        db.execute(f"delete from {table}")
+
+    numberOfRecords = 0
+    numberOfRowsAdded = 0
+    numberOfRowsUpdated = 0
+    highWaterMark = getMetadata(db, "updated_high_water_mark")
+    encoding = getMetadata(db, "record_encoding", "json")
+
+    for chunk in chunked(records, chunkSize):
+        numberOfRecords += len(chunk)
+        for updated in (recordUpdatedDate(r) for r in chunk):
+            if updated and (highWaterMark is None or updated > highWaterMark):
+                highWaterMark = updated
+
+        rows = {}
+        for row in (recordToDb(r) for r in chunk):
+            if row:
+                rows[row[0]] = row + [computeContentChecksum("SHA256", row[4].encode())]
+        db.executemany("insert or ignore into _fetched(item_id) values(?)", [(itemId, ) for itemId in rows])
+
+        # Lookup checksums by batches to stay below the maximum number of SQL variables
+        checksums = {}
+        for itemIds in chunked(rows, 500):
+            checksums.update(db.execute(
+                "select item_id, record_sha256 from _ where item_id in ({0})".format(",".join("?" * len(itemIds))),
+                itemIds))
+
+        changedRows = [row for itemId, row in rows.items() if checksums.get(itemId) != row[-1]]
+        for row in changedRows:
+            row[4] = encodeRecord(row[4], encoding)
+        db.executemany('''insert or replace into _
+            (item_id, revision, checkout_date, build_date, record, os, arch, folder_id, record_sha256)
+            values(?,?,?,?,?,?,?,?,?)''', changedRows)
+        db.executemany("insert or ignore into _changed(item_id) values(?)", [(row[0], ) for row in changedRows])
+
+        numberOfRowsUpdated += sum(1 for row in changedRows if row[0] in checksums)
+        numberOfRowsAdded += sum(1 for row in changedRows if row[0] not in checksums)
+
+    if highWaterMark is not None:
+        setMetadata(db, "updated_high_water_mark", highWaterMark)
+
+    return numberOfRecords, numberOfRowsAdded, numberOfRowsUpdated
+
+
+def getLatestBuildKeys(record):
+    """Return the ``(os, stability, version_prefix)`` keys of the ``_latest`` table the record
+    is a candidate for.
+
+    Stabilities are matched using :func:`slicer_download.recordMatchesStability`.
+
+    The empty ``version_prefix`` is associated with records having a build date, the newest
+    one being returned by the download server when no mode is specified. Other prefixes are the
+    leading components of the record version (see :func:`slicer_download.getVersion`), for
+    example ``5``, ``5.6`` and ``5.6.1`` for version ``5.6.1``.
+    """
+    prefixes = []
+    if getRecordField(record, 'date_creation'):
+        prefixes.append('')
+    version = getVersion(record)
+    if version:
+        parts = version.split('.')
+        prefixes.extend('.'.join(parts[:count]) for count in range(1, len(parts) + 1))
+    operatingSystem = getRecordField(record, 'os')
+    return [(operatingSystem, stability, prefix)
+            for stability in STABILITY_CHOICES if recordMatchesStability(record, stability)
+            for prefix in prefixes]
+
+
+def latestBuildOrder(revision, buildDate):
+    """Return a key ordering ``(revision, build_date)`` column values like SQLite does,
+    NULL values first, then numbers and text."""
+    return tuple((0, 0) if value is None else (1, value) if isinstance(value, (int, float)) else (2, value)
+                 for value in (revision, buildDate))
+
+
+def updateLatestBuilds(db, changedOnly=False):
+    """Update the ``_latest`` table associating the newest record, by revision and build date,
+    with each ``(os, stability, version_prefix)`` key (see :func:`getLatestBuildKeys`).
+
+    If ``changedOnly`` is False or the table is empty, the table is rebuilt from all records,
+    which is required after rows are removed.
+
+    Otherwise only the rows collected in the ``_changed`` temporary table by :func:`updateRecords`
+    are considered: each of them replaces the entry of its keys if it is newer. Keys associated
+    with a changed row before its update are looked up again from the newest record of the same
+    operating system.
+
+    Returns the number of rows written.
+    """
+    query = "select item_id, revision, build_date, record from _ order by revision desc, build_date desc"
+    if not changedOnly or db.execute("select count(1) from _latest").fetchone()[0] == 0:
+        db.execute("delete from _latest")
+        latest = {}
+        for itemId, _, _, record in db.execute(query):
+            for key in getLatestBuildKeys(decodeRecord(record)):
+                latest.setdefault(key, itemId)
+        db.executemany(
+            "insert into _latest(os, stability, version_prefix, item_id) values(?,?,?,?)",
+            [key + (itemId, ) for key, itemId in latest.items()])
+        return len(latest)
+
+    current = {}
+    stale = set()
+    for operatingSystem, stability, prefix, itemId, revision, buildDate, changed in db.execute(
+            """select _latest.os, stability, version_prefix, item_id, revision, build_date,
+            item_id in (select item_id from _changed) from _latest join _ using(item_id)"""):
+        if changed:
+            stale.add((operatingSystem, stability, prefix))
+        else:
+            current[(operatingSystem, stability, prefix)] = (latestBuildOrder(revision, buildDate), itemId)
+
+    latest = {}
+    for itemId, revision, buildDate, record in db.execute(
+            "select item_id, revision, build_date, record from _ where item_id in (select item_id from _changed)"):
+        order = latestBuildOrder(revision, buildDate)
+        for key in getLatestBuildKeys(decodeRecord(record)):
+            if key not in stale and (key not in current or current[key][0] < order):
+                current[key] = (order, itemId)
+                latest[key] = itemId
+
+    # Keys of updated rows may now be associated with older records
+    for operatingSystem in {key[0] for key in stale}:
+        missing = {key for key in stale if key[0] == operatingSystem}
+        for itemId, _, _, record in db.execute(query.replace(" order by", " where os is ? order by"),
+                                               (operatingSystem, )):
+            for key in missing.intersection(getLatestBuildKeys(decodeRecord(record))):
+                latest[key] = itemId
+                missing.remove(key)
+            if not missing:
+                break
+        db.executemany(
+            "delete from _latest where os=? and stability=? and version_prefix=?", list(missing))
+
+    db.executemany(
+        "insert or replace into _latest(os, stability, version_prefix, item_id) values(?,?,?,?)",
+        [key + (itemId, ) for key, itemId in latest.items()])
+    return len(latest)
+
+
+def isLatestBuildsUpdateRequired(db):
+    """Return True if the ``_latest`` table is empty while the records table is not."""
+    return (db.execute("select count(1) from _latest").fetchone()[0] == 0
+            and db.execute("select count(1) from _").fetchone()[0] > 0)
+
+
+def migrateRecordEncoding(db, encoding, chunkSize):
+    """Re-encode all records using ``encoding`` and set the ``record_encoding`` metadata
+    used when inserting or updating records.
+
+    Supported encodings are listed in :const:`slicer_download.RECORD_ENCODINGS`.
+
+    Returns the number of re-encoded rows.
+    """
+    setMetadata(db, "record_encoding", encoding)
+    numberOfRows = 0
+    lastItemId = None
+    while True:
+        if lastItemId is None:
+            rows = db.execute("select item_id, record from _ order by item_id limit ?", (chunkSize, )).fetchall()
+        else:
+            rows = db.execute(
+                "select item_id, record from _ where item_id > ? order by item_id limit ?",
+                (lastItemId, chunkSize)).fetchall()
+        if not rows:
+            return numberOfRows
+        db.executemany(
+            "update _ set record=? where item_id=?",
+            [(encodeRecord(decodeRecordText(record), encoding), itemId) for itemId, record in rows])
+        numberOfRows += len(rows)
+        lastItemId = rows[-1][0]
+
+
+def synchronizeRecords(db, args, cache):
+    """Update the records table with records retrieved from the packages server.
+
+    If a full synchronization is not required (see :func:`isFullSyncRequired`) and no record
+    was updated after the ``updated_high_water_mark`` metadata (see
+    :func:`slicer_download.getLatestRecordUpdatedDate`), the database is left untouched.
+    The metadata is committed along with the records, an interrupted run is resumed by the next one.
+    Midas records are always fully synchronized, responses are cached to save their transfer only.
+
+    After a full synchronization, rows associated with items deleted on the packages server
+    are removed. For :const:`ServerAPI.Girder_v1`, items missing from the retrieved records
+    are first looked up individually (see :func:`slicer_download.getDeletedItemIdsFromURL`)
+    since items deleted during the retrieval may cause others to be skipped.
+
+    If any row was added or updated, the ``_latest`` table is updated within the same
+    transaction, it is rebuilt if any row was removed.
+
+    See :func:`updateRecords` and :func:`updateLatestBuilds`.
+    """
+    fullSync = args.full_sync or isFullSyncRequired(db, args.full_sync_interval_days)
+    if fullSync:
+        records = iterRecordsFromURL(concurrency=args.concurrency, cache=cache)
+    else:
+        updatedSince = getMetadata(db, "updated_high_water_mark")
+        if cache is not None:
+            latestUpdated = getLatestRecordUpdatedDate(cache)
+            if latestUpdated is None or latestUpdated <= updatedSince:
+                print("Records are unchanged since last run")
+                if isLatestBuildsUpdateRequired(db):
+                    print(f"Updated {updateLatestBuilds(db)} latest builds")
+                return
+        print("Retrieving records updated since {0}".format(updatedSince))
+        records = iterRecordsFromURL(updatedSince, concurrency=args.concurrency, cache=cache)
+
+    numberOfRecords, numberOfRowsAdded, numberOfRowsUpdated = updateRecords(db, records, args.chunk_size)
+
+    print("Retrieved {0} records".format(numberOfRecords))
+    print(f"Added {numberOfRowsAdded} rows")
+    print(f"Updated {numberOfRowsUpdated} rows")
+
+    numberOfRowsRemoved = 0
+    if fullSync and numberOfRecords > 0:
+        # Reconcile with the packages server removing rows associated with deleted items
+        itemIds = [row[0] for row in db.execute(
+            "select item_id from _ where item_id not in (select item_id from _fetched)")]
+        if itemIds and getServerAPI() == ServerAPI.Girder_v1:
+            print(f"Looking up {len(itemIds)} items missing from retrieved records")
+            itemIds = getDeletedItemIdsFromURL(itemIds, args.concurrency)
+        db.executemany("delete from _ where item_id = ?", [(itemId, ) for itemId in itemIds])
+        numberOfRowsRemoved = len(itemIds)
+        print(f"Removed {numberOfRowsRemoved} rows")
+        setMetadata(db, "last_full_sync", datetime.datetime.utcnow().isoformat())
+
+    if numberOfRowsRemoved > 0 or isLatestBuildsUpdateRequired(db):
+        print(f"Updated {updateLatestBuilds(db)} latest builds")
+    elif numberOfRowsAdded + numberOfRowsUpdated > 0:
+        print(f"Updated {updateLatestBuilds(db, changedOnly=True)} latest builds")
+
+
+def applicationPackageToIDs(db, duplicatesOnly=False, itemIds=None):
     """Return a dictionary of ``<revision>-<os>-<arch>`` (uniquely identifying an application package)
     to list of ``(itemId, folderId)`` tuples.
 
     This function returns a dictionary containing keys that are uniquely
     identifying an application package, and values that are a list of tuples
-    containing the itemId and folderId of the corresponding records from a
+    containing the itemId and folderId of the corresponding rows from a
     Girder database (see :const:`ServerAPI.Girder_v1`).
+
+    If ``duplicatesOnly`` is True, only application packages associated with more
+    than one item are returned. If ``itemIds`` is specified, only application packages
+    associated with these items are returned.
+
+    Lookups are done using the index associated with the ``revision``, ``os`` and ``arch``
+    columns (see :func:`createRecordsTables`).
     """
     assert getServerAPI() == ServerAPI.Girder_v1
+    query = "select revision, os, arch, item_id, folder_id from _"
+    if duplicatesOnly:
+        query = '''select _.revision, _.os, _.arch, _.item_id, _.folder_id from _
+            join (select revision, os, arch from _ group by revision, os, arch having count(*) > 1)
+            using (revision, os, arch)'''
+    if itemIds is not None:
+        db.execute("create temp table if not exists _selected(item_id primary key)")
+        db.execute("delete from _selected")
+        db.executemany("insert or ignore into _selected(item_id) values(?)", [(itemId, ) for itemId in itemIds])
+        query += " where item_id in (select item_id from _selected)"
     packages = {}
-    for record in records:
-        key = "%s-%s-%s" % (record["meta"]["revision"], record["meta"]["os"], record["meta"]["arch"])
-        itemId = record["_id"]
-        folderId = record["folderId"]
-        if key not in packages:
-            packages[key] = [(itemId, folderId)]
-        else:
-            packages[key].append((itemId, folderId))
+    for revision, operatingSystem, arch, itemId, folderId in db.execute(query + " order by _.rowid"):
+        key = "%s-%s-%s" % (revision, operatingSystem, arch)
+        packages.setdefault(key, []).append((itemId, folderId))
 
-    return {key: item_ids for key, item_ids in packages.items()}
+    return packages
+
+
+def removeItems(db, itemIds):
+    """Remove rows associated with ``itemIds`` and rebuild the ``_latest`` table.
+
+    See :func:`updateLatestBuilds`.
+    """
+    packagesByItemId = {}
+    for key, ids in applicationPackageToIDs(db, itemIds=itemIds).items():
+        for itemId, _ in ids:
+            packagesByItemId[itemId] = key
+
+    print(f"Removing {len(itemIds)} rows")
+    for itemId in itemIds:
+        if itemId not in packagesByItemId:
+            print(f"  {itemId} (not found)")
+            continue
+        print(f"  {itemId} ({packagesByItemId[itemId]})")
+    cursor = db.executemany("delete from _ where item_id=?", [(itemId, ) for itemId in packagesByItemId])
+    print(f"Removed {cursor.rowcount} rows")
+    print(f"Updated {updateLatestBuilds(db)} latest builds")
 
 
 def computeContentChecksum(algo, content):
@@ -111,7 +509,7 @@ def computeContentChecksum(algo, content):
     return digest.hexdigest()
 
 
-def displayDuplicateDrafts(records):
+def displayDuplicateDrafts(db, releases):
     """Display table of duplicate ``<revision>-<os>-<arch>`` and corresponding draft folder URLs
     and draft item IDS.
 
@@ -119,20 +517,22 @@ def displayDuplicateDrafts(records):
     and `folderId` where `release` is displayed as `<DRAFT>` if no matching release was found.
 
     The matching with a release is done by checking if the `folderId` associated with the
-    `<revision>-<os>-<arch>` item is found in the list of releases returned using
-    https://slicer-packages.kitware.com/api/v1/app/5f4474d0e1d8c75dfc705482/release?limit=0.
+    `<revision>-<os>-<arch>` item is found in the list of ``releases`` returned using
+    https://slicer-packages.kitware.com/api/v1/app/5f4474d0e1d8c75dfc705482/release?limit=0
+    (see :func:`slicer_download.getReleasesFromURL`).
+
+    Duplicates are looked up in the records table of ``db`` (see :func:`applicationPackageToIDs`).
     """
     assert getServerAPI() == ServerAPI.Girder_v1
 
-    duplicates = {key: item_ids for key, item_ids in applicationPackageToIDs(records).items() if len(item_ids) > 1}
+    duplicates = applicationPackageToIDs(db, duplicatesOnly=True)
 
     if len(duplicates) == 0:
         print("")
         print("No duplicate identified")
         return
 
-    result = requests.get("{0}/app/5f4474d0e1d8c75dfc705482/release?limit=0".format(getServerAPIUrl()))
-    releases = {release["_id"]: release["name"] for release in result.json()}
+    releases = {release["_id"]: release["name"] for release in releases}
 
     draftItemIds = []
     draftFolderIds = set()
@@ -161,15 +561,42 @@ def main():
     argparser.add_argument("--display-duplicate-drafts", action="store_true", help="Display duplicate draft folders & items and exit")
     argparser.add_argument("--remove-itemids", help="comma separated list of itemid to remove from the database")
     argparser.add_argument("--skip-db-insert-or-update", action="store_true", help="skip database insert or update of rows")
+    argparser.add_argument("--full-sync", action="store_true",
+                           help="retrieve all records and remove rows associated with deleted items")
+    argparser.add_argument("--full-sync-interval-days", type=float, default=7,
+                           help="number of days after which a full synchronization is performed (default: 7)")
+    argparser.add_argument("--chunk-size", type=int, default=1000,
+                           help="number of records inserted at once into the database (default: 1000)")
+    argparser.add_argument("--concurrency", type=int, default=4,
+                           help="maximum number of concurrent requests sent to the packages server (default: 4)")
+    argparser.add_argument("--migrate-record-encoding", choices=RECORD_ENCODINGS,
+                           help="re-encode all records, and records inserted or updated afterward, and exit")
+    argparser.add_argument("--http-cache-dir",
+                           help="directory caching responses of the packages server "
+                                "(default: <DB_FILE directory>/http-cache)")
+    argparser.add_argument("--skip-http-cache", action="store_true",
+                           help="skip conditional requests using cached responses")
     argparser.add_argument("dbfile", metavar="DB_FILE", nargs="?")
     args = argparser.parse_args()
     dbfile = args.dbfile
 
     print("ServerAPI is {0}: {1}".format(getServerAPI().name, getServerAPIUrl()))
 
+    cache = None
+    if args.http_cache_dir and not args.skip_http_cache:
+        cache = ResponseCache(args.http_cache_dir)
+
     if args.display_duplicate_drafts:
-        records = getRecordsFromURL()
-        displayDuplicateDrafts(getRecordsFromURL())
+        # records are streamed into a temporary database to keep memory usage bounded
+        releases = getReleasesFromURL(cache)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = sqlite3.connect(os.path.join(tmpdir, "records.sqlite"))
+            try:
+                createRecordsTables(db)
+                updateRecords(db, iterRecordsFromURL(concurrency=args.concurrency, cache=cache), args.chunk_size)
+                displayDuplicateDrafts(db, releases)
+            finally:
+                db.close()
         sys.exit(0)
 
     itemIdsToRemove = set()
@@ -182,77 +609,44 @@ def main():
     if dbfile is None:
         argparser.error("No action requested, specify --display-duplicate-drafts or DB_FILE")
 
-    records = getRecordsFromURL()
-    print("Retrieved {0} records".format(len(records)))
+    if args.migrate_record_encoding:
+        try:
+            encodeRecord("", args.migrate_record_encoding)
+        except ValueError as exception:
+            argparser.error(str(exception))
+        with sqlite3.connect(dbfile) as db:
+            print("")
+            createRecordsTables(db)
+            print(f"Re-encoding records using '{args.migrate_record_encoding}'")
+            numberOfRows = migrateRecordEncoding(db, args.migrate_record_encoding, args.chunk_size)
+            db.commit()
+            print(f"Updated {numberOfRows} rows")
+            # Reclaim space freed by compressed records
+            db.execute("vacuum")
+        print("Saved {0}".format(dbfile))
+        sys.exit(0)
 
     if not args.skip_db_insert_or_update:
-        primary_key_type = "INTEGER" if getServerAPI() == ServerAPI.Midas_v1 else "TEXT"
+        if cache is None and not args.skip_http_cache:
+            cache = ResponseCache(os.path.join(os.path.dirname(os.path.abspath(dbfile)), "http-cache"))
 
         with sqlite3.connect(dbfile) as db:
             print("")
-            db.execute('''create table if not exists
-            _(item_id {primary_key_type} primary key,
-                        revision INTEGER,
-                        checkout_date TEXT,
-                        build_date TEXT,
-                        record TEXT)'''.format(primary_key_type=primary_key_type))
-
-            # Since when using the `insert or replace into` statement below, all records are effectively
-            # replaced independently of their value, the `cursor.rowcount` property does not allow to
-            # know the number of records effectively updated.
-            #
-            # To address this, we compute the checksum of all records before and after and use that to
-            # infer the number of record added and updated.
-            cursor = db.cursor()
-            cursor.execute("select item_id, record from _")
-            checksumOfRecordsBefore = {row[0]: computeContentChecksum("SHA256", row[1].encode()) for row in cursor.fetchall()}
-            numberOfRowsBefore = len(checksumOfRecordsBefore)
-
-            cursor = db.cursor()
-            cursor.executemany('''insert or replace into _
-                (item_id, revision, checkout_date, build_date, record)
-                values(?,?,?,?,?)''',
-                            [_f for _f in (recordToDb(r) for r in records) if _f])
-
-            cursor = db.cursor()
-            cursor.execute("select count(*) from _")
-            numberOfRowsAfter = cursor.fetchone()[0]
-
-            cursor = db.cursor()
-            cursor.execute("select item_id, record from _")
-            recordsChecksumAfter= {
-                row[0]: computeContentChecksum("SHA256", row[1].encode()) for row in cursor.fetchall()
-                if row[0] in checksumOfRecordsBefore
-            }
-            numberOfRowsModified = len(set(recordsChecksumAfter.values()) - set(checksumOfRecordsBefore.values()))
-
-            print(f"Added {numberOfRowsAfter - numberOfRowsBefore} rows")
-            print(f"Updated {numberOfRowsModified} rows")
-
+            createRecordsTables(db)
+            synchronizeRecords(db, args, cache)
             db.commit()
 
         print("Saved {0}".format(dbfile))
 
     if len(itemIdsToRemove) > 0:
         print("")
-        packages = applicationPackageToIDs(getRecordsFromDB(dbfile))
-        packagesByItemId = {}
-        for key, ids in packages.items():
-            for itemId, _ in ids:
-                packagesByItemId[itemId] = key
-
         with sqlite3.connect(dbfile) as db:
-            print(f"Removing {len(itemIdsToRemove)} rows")
-            for itemId in itemIdsToRemove:
-                if itemId not in packagesByItemId:
-                    print(f"  {itemId} (not found)")
-                    continue
-                db.execute("delete from _ where item_id=?", (itemId, ))
-                print(f"  {itemId} ({packagesByItemId[itemId]})")
+            createRecordsTables(db)
+            removeItems(db, itemIdsToRemove)
             db.commit()
-            print(f"Removed {db.total_changes} rows")
 
         print("Saved {0}".format(dbfile))
 
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,186 @@
+"""Check slicer_getbuildinfo against a local stand-in of the Girder packages server.
+
+Usage: t-standin.py [NUMBER_OF_RECORDS]
+
+A stand-in server listing NUMBER_OF_RECORDS generated package records (default: 1000)
+is started in a background thread and slicer_getbuildinfo is run against it using the
+SLICER_DOWNLOAD_SERVER_API_URL environment variable. The peak memory of each run is
+reported (Linux only), it is expected to stay about the same whatever the number of records.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+
+from aiohttp import web
+
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+GETBUILDINFO_DIR = os.path.join(ROOT_DIR, 'etc', 'slicer_getbuildinfo')
+
+sys.path.insert(0, ROOT_DIR)
+import slicer_download  # noqa: E402
+
+OPERATING_SYSTEMS = ('win', 'macosx', 'linux')
+
+# run slicer_getbuildinfo reporting its peak resident memory, the high-water mark of
+# getrusage() would include the memory of this process forked before exec
+PEAK_MEMORY_WRAPPER = """
+import atexit, runpy, sys
+def reportPeakMemory():
+    with open('/proc/self/status') as fp:
+        print(next(line for line in fp if line.startswith('VmHWM:')), end='')
+atexit.register(reportPeakMemory)
+sys.argv = sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name='__main__')
+"""
+
+
+def createRecord(index):
+    day = "2023-{0:02d}-{1:02d}".format(index // 28 % 12 + 1, index % 28 + 1)
+    return {
+        "_id": "{0:024x}".format(index),
+        "folderId": "{0:024x}".format(index // 30),
+        "name": "Slicer-{0:024x}".format(index),
+        "size": 1000,
+        "created": day + "T00:00:00",
+        "updated": day + "T00:00:00",
+        "meta": {
+            "os": OPERATING_SYSTEMS[index % 3],
+            "arch": "amd64",
+            "revision": str(29000 + index // 3),
+            "build_date": day + "T10:00:00Z",
+            "baseName": "Slicer",
+            "version": "5.0.0-" + day,
+            "release": "",
+            "pre_release": "False",
+        },
+    }
+
+
+class StandInServer:
+    """Girder routes used by slicer_getbuildinfo, serving ``records`` from memory."""
+
+    def __init__(self, records):
+        self.records = {record["_id"]: record for record in records}
+        self.url = None
+
+    def jsonResponse(self, request, document):
+        body = json.dumps(document).encode()
+        etag = '"{0}"'.format(hashlib.sha256(body).hexdigest())
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        response = web.Response(body=body, content_type="application/json", headers={"ETag": etag})
+        response.enable_compression()
+        return response
+
+    async def listPackages(self, request):
+        query = request.query
+        records = sorted(self.records.values(), key=lambda record: record[query.get("sort", "_id")],
+                         reverse=query.get("sortdir") == "-1")
+        offset = int(query.get("offset", 0))
+        limit = int(query.get("limit", 50))
+        return self.jsonResponse(request, records[offset:offset + limit] if limit else records)
+
+    async def listReleases(self, request):
+        return self.jsonResponse(request, [])
+
+    async def getItem(self, request):
+        record = self.records.get(request.match_info["itemId"])
+        if record is None:
+            return web.json_response({"message": "Invalid item id"}, status=400)
+        return self.jsonResponse(request, record)
+
+    def start(self):
+        app = web.Application()
+        app.router.add_get("/api/v1/app/{appId}/package", self.listPackages)
+        app.router.add_get("/api/v1/app/{appId}/release", self.listReleases)
+        app.router.add_get("/api/v1/item/{itemId}", self.getItem)
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        self.url = "http://127.0.0.1:{0}/api/v1".format(sock.getsockname()[1])
+        started = threading.Event()
+
+        def run():
+            loop = asyncio.new_event_loop()
+            runner = web.AppRunner(app)
+            loop.run_until_complete(runner.setup())
+            loop.run_until_complete(web.SockSite(runner, sock).start())
+            started.set()
+            loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        started.wait()
+
+
+def runGetBuildInfo(server, *args):
+    env = dict(os.environ, PYTHONPATH=ROOT_DIR, SLICER_DOWNLOAD_SERVER_API="Girder_v1",
+               SLICER_DOWNLOAD_SERVER_API_URL=server.url)
+    result = subprocess.run([sys.executable, "-c", PEAK_MEMORY_WRAPPER, GETBUILDINFO_DIR] + list(args), env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    peak = int(result.stdout.rsplit("VmHWM:", 1)[1].split()[0]) if "VmHWM:" in result.stdout else 0
+    print("$ slicer_getbuildinfo {0}: exit code {1}, peak memory {2} MiB".format(
+        " ".join(args), result.returncode, peak // 1024))
+    if result.returncode != 0:
+        print(result.stdout)
+    return result
+
+
+def readRows(dbfile):
+    with sqlite3.connect(dbfile) as db:
+        return {itemId: json.loads(record) for itemId, record in db.execute("select item_id, record from _")}
+
+
+def check(description, condition):
+    print("{0}: {1}".format(description, "ok" if condition else "FAILED"))
+    return condition
+
+
+numberOfRecords = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+server = StandInServer(createRecord(index) for index in range(numberOfRecords))
+server.start()
+
+success = True
+
+# draft package uploaded twice
+duplicate = dict(createRecord(numberOfRecords // 4), _id="{0:024x}".format(numberOfRecords))
+server.records[duplicate["_id"]] = duplicate
+result = runGetBuildInfo(server, "--display-duplicate-drafts")
+success &= check("duplicate drafts displayed", "{0:024x},{1:024x}".format(numberOfRecords // 4, numberOfRecords)
+                 in result.stdout)
+del server.records[duplicate["_id"]]
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    dbfile = os.path.join(tmpdir, "records.sqlite")
+
+    runGetBuildInfo(server, "--full-sync", dbfile)
+    success &= check("all records retrieved", len(readRows(dbfile)) == numberOfRecords)
+
+    updated = server.records["{0:024x}".format(numberOfRecords // 2)]
+    updated["size"] = 2000
+    updated["updated"] = "2024-01-01T00:00:00"
+    runGetBuildInfo(server, dbfile)
+    success &= check("updated record retrieved", readRows(dbfile)[updated["_id"]]["size"] == 2000)
+
+    # a run interrupted after caching the first page must not hide the update from the next one
+    updated["size"] = 3000
+    updated["updated"] = "2024-02-01T00:00:00"
+    os.environ.update(SLICER_DOWNLOAD_SERVER_API="Girder_v1", SLICER_DOWNLOAD_SERVER_API_URL=server.url)
+    slicer_download.getLatestRecordUpdatedDate(slicer_download.ResponseCache(os.path.join(tmpdir, "http-cache")))
+    runGetBuildInfo(server, dbfile)
+    success &= check("update retrieved after interrupted run", readRows(dbfile)[updated["_id"]]["size"] == 3000)
+
+    result = runGetBuildInfo(server, dbfile)
+    success &= check("unchanged records skipped", "Records are unchanged since last run" in result.stdout)
+
+    deleted = server.records.pop("{0:024x}".format(numberOfRecords // 3))
+    runGetBuildInfo(server, "--full-sync", dbfile)
+    success &= check("deleted record removed", deleted["_id"] not in readRows(dbfile))
+
+sys.exit(0 if success else 1)
@@ -0,0 +1,60 @@
+import collections
+
+from slicer_download import chunked
+
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def write_rows(db, statement, rows, chunk_size=DEFAULT_CHUNK_SIZE, prepare=None):
+    """Execute statement for each of the rows, committing every chunk_size rows.
+
+    Rows are consumed lazily, an interrupted run keeps the chunks
+    committed so far and the next run resumes after the last one.
+    If set, prepare is called with the database and each chunk before
+    executing the statement, within the same transaction.
+    Return the number of rows written."""
+    count = 0
+    for chunk in chunked(rows, chunk_size):
+        if prepare is not None:
+            prepare(db, chunk)
+        db.executemany(statement, chunk)
+        db.commit()
+        count += len(chunk)
+    return count
+
+
+def map_bounded(executor, fn, *iterables, window):
+    """Yield the results of fn called with the items of iterables in executor.
+
+    Unlike executor.map(), iterables are consumed lazily and at most window
+    calls are submitted ahead of the result being consumed. Results are
+    yielded in order, calls not started yet are cancelled on exit."""
+    pending = collections.deque()
+    try:
+        for args in zip(*iterables):
+            pending.append(executor.submit(fn, *args))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def create_meta_table(db):
+    """Create the table associating values with keys, see get_meta() and set_meta()."""
+    with db as c:
+        c.execute("create table if not exists meta (key primary key, value)")
+
+
+def get_meta(db, key, default=None):
+    """Return value associated with key in the 'meta' table."""
+    row = db.execute("select value from meta where key = ?", (key,)).fetchone()
+    return default if row is None else row[0]
+
+
+def set_meta(db, key, value):
+    """Associate value with key in the 'meta' table."""
+    db.execute("insert or replace into meta(key, value) values(?, ?)", (key, value))
@@ -1,4 +1,5 @@
 import argparse
+import datetime
 import json
 import sys
 
@@ -8,6 +9,8 @@ from slicer_download import (
 )
 
 from slicer_parselogs import (
+    DEFAULT_CHUNK_SIZE,
+    create_meta_table,
     access,
     bitstream,
     geoip,
@@ -16,13 +19,56 @@ from slicer_parselogs import (
 )
 
 
-def generate_slicer_stats(db, slicer_stats_data_file):
-    slicer_stats_data = slicerstats.get_download_stats_data(db)
+def generate_slicer_stats(db, slicer_stats_data_file, since=None, until=None):
+    slicerstats.update_access_first(db)
+    slicer_stats_data = slicerstats.get_download_stats_data(db, since, until)
     with open(slicer_stats_data_file, 'w+') as statsfp:
         print('writing %s' % slicer_stats_data_file)
         json.dump(slicer_stats_data, statsfp, separators=(',', ':'), indent=2)
 
 
+def parse_time(value):
+    """Convert an ISO 8601 date or time into seconds since the epoch,
+    times without time zone are in UTC."""
+    dt = datetime.datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return int(dt.timestamp())
+
+
+def create_tables(db):
+    """Create the stats tables, converting tables created before the
+    introduction of the 'bitstream', 'ip' and 'useragent' tables."""
+    create_meta_table(db)
+    migrated = [
+        access.create_access_table(db),
+        bitstream.create_bitstream_table(db),
+        geoip.create_geoip_table(db),
+        useragent.create_useragent_table(db),
+        slicerstats.create_access_first_table(db),
+    ]
+    if any(migrated):
+        print("vacuuming database")
+        db.execute("vacuum")
+
+
+def enable_bulk_load(db):
+    """Trade durability for speed while loading large amounts of rows.
+
+    A crash may lose the rows committed since the last checkpoint of the
+    write-ahead log, the database should then be rebuilt from the logs."""
+    print("enabling bulk load")
+    db.execute("pragma journal_mode = wal")
+    db.execute("pragma synchronous = off")
+    db.execute("pragma cache_size = -262144")  # 256 MiB
+    db.execute("pragma temp_store = memory")
+
+
+def disable_bulk_load(db):
+    db.execute("pragma journal_mode = delete")
+    db.execute("pragma synchronous = full")
+
+
 def main():
     argparser = argparse.ArgumentParser(description='Process Slicer4 download information.')
     argparser.add_argument('--db', required=True, help="sqlite stats database")
@@ -30,8 +76,35 @@ def main():
     argparser.add_argument('--statsdata', required=False, help="slicer stats output")
     argparser.add_argument('--only-statsdata', action='store_true', help="skip database update and only generate stats output")
     argparser.add_argument('--skip-records-fetch', action='store_true', help="skip fetching of records from packages server")
+    argparser.add_argument('--records-db', help="records database updated by slicer_getbuildinfo, "
+                                                "read instead of fetching records from packages server")
     argparser.add_argument('--update-useragent-table', action='store_true', help="update useragent table entries")
+    argparser.add_argument('--refresh-geoip', action='store_true',
+                           help="look up again the location of IPs if the geoip data file is newer "
+                                "than the one used so far")
     argparser.add_argument('--dry-run', action='store_true', help="simulate database update")
+    argparser.add_argument('--log-parser', choices=sorted(access.LOG_PARSERS), default='fast',
+                           help="parser used for access log entries (default: fast)")
+    argparser.add_argument('--jobs', type=int, default=1,
+                           help="number of processes parsing log files, refreshing IP locations or "
+                                "classifying user agents in parallel (default: 1)")
+    argparser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                           help=f"number of rows committed at once into the database (default: {DEFAULT_CHUNK_SIZE})")
+    argparser.add_argument('--bulk-load', action='store_true',
+                           help="speed up loading of many log files, e.g. when rebuilding the database, "
+                                "at the expense of crash safety")
+    argparser.add_argument('--filter-robots', action='store_true',
+                           help="only count accesses of robots per day and bitstream instead of recording them, "
+                                "their user agents are classified with the installed ua-parser once and for all")
+    argparser.add_argument('--since', type=parse_time,
+                           help="only include accesses at or after this ISO 8601 date or time (UTC) in stats output")
+    argparser.add_argument('--until', type=parse_time,
+                           help="only include accesses before this ISO 8601 date or time (UTC) in stats output")
+    argparser.add_argument('--geoip-granularity', choices=geoip.GEOIP_GRANULARITIES,
+                           help="store location per IP or per GeoIP network, "
+                                "the choice is remembered in the database (default: ip)")
+    argparser.add_argument('--rebuild-stats-tables', action='store_true',
+                           help="rebuild the tables of accesses aggregated for the stats output")
     argparser.add_argument('filenames', nargs="*")
     args = argparser.parse_args()
     dbname = args.db
@@ -44,11 +117,25 @@ def main():
             argparser.error('with --only-statsdata, the following arguments are required: --statsdata')
 
         with openDb(dbname) as db:
-            generate_slicer_stats(db, statsdata)
+            create_tables(db)
+            if args.rebuild_stats_tables:
+                slicerstats.reset_access_first(db)
+            generate_slicer_stats(db, statsdata, args.since, args.until)
         sys.exit(0)
 
     if args.update_useragent_table:
-        useragent.update_useragent_info(dbname, dry_run=args.dry_run)
+        with openDb(dbname) as db:
+            create_tables(db)
+        useragent.update_useragent_info(dbname, dry_run=args.dry_run, jobs=args.jobs, chunk_size=args.chunk_size)
+        sys.exit(0)
+
+    if args.refresh_geoip:
+        if geoip_filename is None:
+            argparser.error('with --refresh-geoip, the following arguments are required: --geoip')
+
+        with openDb(dbname) as db:
+            create_tables(db)
+            geoip.refresh_geoip_info(db, geoip_filename, args.jobs, args.chunk_size, dry_run=args.dry_run)
         sys.exit(0)
 
     required_args = [
@@ -61,22 +148,38 @@ def main():
 
     with openDb(dbname) as db:
 
-        access.create_access_table(db)
-        bitstream.create_bitstream_table(db)
-        geoip.create_geoip_table(db)
-        useragent.create_useragent_table(db)
+        if args.bulk_load:
+            enable_bulk_load(db)
+
+        create_tables(db)
 
         # parse apache logs, if they exist, and add them to db
-        access.add_access_info(db, filenames)
+        if args.bulk_load:
+            # indexes are rebuilt once all rows are inserted
+            access.drop_access_indexes(db)
+        access.add_access_info(db, filenames, args.log_parser, args.jobs, args.chunk_size, args.filter_robots)
+        if args.bulk_load:
+            print("creating 'access' indexes")
+            access.create_access_indexes(db)
+            db.commit()
+            print("analyzing database")
+            db.execute("analyze")
+            disable_bulk_load(db)
 
         # each of these items depends on the access table
-        geoip.add_geoip_info(db, geoip_filename)
-        useragent.add_useragent_info(db)
-        if not args.skip_records_fetch:
-            bitstream.add_bitstream_info(db, getRecordsFromURL())
+        if args.geoip_granularity:
+            geoip.set_geoip_granularity(db, args.geoip_granularity)
+        geoip.add_geoip_info(db, geoip_filename, args.chunk_size)
+        useragent.add_useragent_info(db, args.jobs, args.chunk_size)
+        if args.records_db:
+            bitstream.add_bitstream_info_from_db(db, args.records_db)
+        elif not args.skip_records_fetch:
+            bitstream.add_bitstream_info(db, getRecordsFromURL(), args.chunk_size)
 
         # then write out slicer json
-        generate_slicer_stats(db, statsdata)
+        if args.rebuild_stats_tables:
+            slicerstats.reset_access_first(db)
+        generate_slicer_stats(db, statsdata, args.since, args.until)
 
     sys.exit(0)
 
@@ -1,76 +1,466 @@
+import collections
+import concurrent.futures
 import sys
 import re
 import gzip
+import hashlib
+import itertools
+import mmap
 import os
+import pickle
+import tempfile
 import apache_log_parser
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
 
 from slicer_download import (
     getServerAPI,
     ServerAPI
 )
 
+from slicer_parselogs import (
+    DEFAULT_CHUNK_SIZE,
+    map_bounded,
+    write_rows
+)
+from slicer_parselogs.useragent import get_browser_type
+
 bitstreamRE = {
     ServerAPI.Midas_v1: re.compile(r'/bitstream/(\d+)'),
     ServerAPI.Girder_v1: re.compile(r'/bitstream/([a-fA-F\d]{24})')
 }
 
 
+# dimension tables associating an integer key with each distinct value
+# of the access columns: (table, key, value, index in access rows)
+DIMENSIONS = [
+    ('bitstream', 'bs_id', 'bitstream_id', 0),
+    ('ip', 'ip_id', 'ip', 1),
+    ('useragent', 'useragent_id', 'useragent', 3),
+]
+
+ACCESS_INSERT = """insert or ignore into access(bs_id, ip_id, ts, useragent_id)
+    values((select bs_id from bitstream where bitstream_id = ?),
+           (select ip_id from ip where ip = ?),
+           ?,
+           (select useragent_id from useragent where useragent = ?))"""
+
+ROBOT_ACCESS_INSERT = """insert into robot_access(day, bs_id, count)
+    values(?, (select bs_id from bitstream where bitstream_id = ?), ?)
+    on conflict(day, bs_id) do update set count = count + excluded.count"""
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
 def create_access_table(db):
-    "Initialize sqlite table for web access records."
+    """Initialize sqlite table for web access records.
+
+    Return True if the table was converted by migrate_access_table()
+    or migrate_access_time()."""
     print("creating 'access' table")
     with db as c:
+        columns = [row[1] for row in c.execute("pragma table_info(access)")]
+        migrated = 'ip' in columns
+        if migrated:
+            migrate_access_table(c)
+
+        for table, key, value, _ in DIMENSIONS:
+            c.execute(f'''create table if not exists
+                {table} ({key} integer primary key, {value} unique)
+                ''')
+
+        # ts is the access time in seconds since the epoch
         c.execute('''create table if not exists
-                access (bitstream_id, ip, ts, useragent)
+                access (bs_id integer, ip_id integer, ts integer, useragent_id integer)
                 ''')
 
-        c.execute('''create unique index if not exists access_unique_idx
-                    on access(bitstream_id, ip, ts)''')
+        create_access_indexes(c)
 
+        # text sorts after integers, the most recent row is text
+        # only if the table stores ISO 8601 access times
+        row = c.execute("select typeof(ts) from access order by ts desc limit 1").fetchone()
+        if row is not None and row[0] == 'text':
+            migrated = True
+            migrate_access_time(c)
 
-def add_access_info(db, filenames):
-    """Add bitstream access information to sqlite table."""
-    print("populating 'access' table")
-    for access in read_and_parse(filenames):
-        req = access['request_url_path']
-        m = bitstreamRE[getServerAPI()].match(req)
-        if not m:
-            continue
+        # number of accesses of robots filtered out of the 'access' table,
+        # day is the start of the day in seconds since the epoch
+        c.execute('''create table if not exists
+                robot_access (day integer, bs_id integer, count integer,
+                              primary key(day, bs_id))
+                ''')
 
-        host = access['remote_ip']
-        user_agent = access['request_header_user_agent']
-        access_time = access['time_received_utc_isoformat']
-        bitstream_id = m.group(1)
-        db.execute("""insert or ignore into access(bitstream_id, ip, ts, useragent)
-                    values(?, ?, ?, ?)""",
-                    (bitstream_id, host, access_time, user_agent))
-    db.commit()
+        # offset of the first unprocessed byte of each log file, files are
+        # identified by device and inode, or by checksum of their first
+        # decompressed bytes once rotated, see read_checkpoint()
+        c.execute('''create table if not exists
+                access_checkpoint (dev, inode, head_size, head_sha256,
+                                   size, offset, complete, filename,
+                                   primary key(dev, inode))
+                ''')
+        c.execute("create index if not exists access_checkpoint_head_idx on access_checkpoint(head_sha256)")
+    return migrated
 
 
-def read_and_parse(filenames):
-    """Read all apache log files (possibly gzipped) and 
-       yield each parsed bitsteam download event."""
-    log_parser = create_log_parser()
-    for filename in filenames:
-        print("parsing '{0}'".format(filename))
+def create_access_indexes(db):
+    """Create the indexes of the 'access' table.
+
+    If access_unique_idx is missing (see drop_access_indexes()), duplicated
+    rows are removed first, keeping the first inserted one."""
+    if db.execute("select 1 from sqlite_master where type = 'index' and name = 'access_unique_idx'").fetchone() is None:
+        db.execute('''delete from access where rowid not in
+                   (select min(rowid) from access group by bs_id, ip_id, ts)''')
+
+    db.execute('''create unique index if not exists access_unique_idx
+               on access(bs_id, ip_id, ts)''')
+
+    db.execute('''create index if not exists access_ts_idx
+               on access(ts)''')
+
+
+def drop_access_indexes(db):
+    """Drop the indexes of the 'access' table to speed up bulk inserts.
+
+    Rows are then inserted without checking for duplicates until
+    create_access_indexes() is called."""
+    db.execute("drop index if exists access_unique_idx")
+    db.execute("drop index if exists access_ts_idx")
+
+
+def migrate_access_table(db):
+    """Convert the 'access' table storing bitstream IDs, IPs and user
+    agents as text into one referencing the dimension tables."""
+    print("migrating 'access' table")
+    db.execute("begin")
+    db.execute("drop index if exists access_unique_idx")
+    db.execute("alter table access rename to access_text")
+    for table, key, value, _ in DIMENSIONS:
+        db.execute(f"create table if not exists {table} ({key} integer primary key, {value} unique)")
+        db.execute(f"insert or ignore into {table}({value}) select {value} from access_text order by rowid")
+    db.execute('''create table access (bs_id integer, ip_id integer, ts integer, useragent_id integer)''')
+    db.execute('''insert into access(bs_id, ip_id, ts, useragent_id)
+               select bs_id, ip_id, ts, useragent_id from access_text
+                   join bitstream using(bitstream_id)
+                   join ip using(ip)
+                   join useragent using(useragent)
+               order by access_text.rowid''')
+    db.execute("drop table access_text")
 
+
+def migrate_access_time(db):
+    """Convert ISO 8601 access times into seconds since the epoch."""
+    print("migrating 'access' table times")
+    db.execute("""update or replace access set ts = cast(strftime('%s', ts) as integer)
+               where typeof(ts) = 'text'""")
+
+
+def insert_dimension_values(db, rows):
+    """Add the values found in the access rows to the dimension tables."""
+    for table, _, value, index in DIMENSIONS:
+        db.executemany(f"insert or ignore into {table}({value}) values(?)",
+                       [(v,) for v in dict.fromkeys(row[index] for row in rows)])
+
+
+def add_robot_access_counts(db, counts):
+    """Add the counts associating (day, bitstream_id) with a number of
+    accesses to the 'robot_access' table."""
+    db.executemany("insert or ignore into bitstream(bitstream_id) values(?)",
+                   [(bitstream_id,) for bitstream_id in dict.fromkeys(key[1] for key in counts)])
+    db.executemany(ROBOT_ACCESS_INSERT, [(day, bitstream_id, count) for (day, bitstream_id), count in counts.items()])
+
+
+def add_access_info(db, filenames, log_parser_name='fast', jobs=1, chunk_size=DEFAULT_CHUNK_SIZE,
+                    filter_robots=False):
+    """Add bitstream access information to sqlite table.
+
+    Each file is read starting from the offset recorded in the
+    'access_checkpoint' table, files already processed entirely
+    are skipped.
+
+    Log entries are parsed using the parser associated with
+    log_parser_name in LOG_PARSERS. If jobs is greater than 1,
+    files are parsed in a pool of jobs processes, at most twice as
+    many as processes ahead of the insertion, and the rows are
+    inserted in the order of filenames. Workers spool the rows
+    by chunks in a temporary directory, see spool_access_file().
+
+    If filter_robots is set, accesses of robots are only counted per day
+    and bitstream in the 'robot_access' table.
+
+    Rows are committed by chunks of chunk_size rows and the checkpoint,
+    along with the robot access counts of the file, once all rows of the
+    file are written. A file interrupted midway is parsed again, rows
+    already inserted are ignored and its robot accesses are counted once."""
+    print("populating 'access' table")
+    checkpoints = []
+    for filename in filenames:
         if not os.path.exists(filename):
             print("failed to open '{0}': file do not exist !".format(filename), file=sys.stderr)
             continue
 
-        if os.path.splitext(filename)[1] == '.gz':
-            fp = gzip.open(filename, 'rt')
+        checkpoint = read_checkpoint(db, filename)
+        if is_checkpoint_complete(checkpoint):
+            print("skipping '{0}': already processed".format(filename))
+            continue
+        checkpoints.append(checkpoint)
+
+    with tempfile.TemporaryDirectory(prefix='slicer_parselogs-') as spool_dir:
+        if jobs > 1 and len(checkpoints) > 1:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+            spools = map_bounded(executor, spool_access_file, checkpoints, itertools.repeat(log_parser_name),
+                                 itertools.repeat(filter_robots), itertools.repeat(chunk_size),
+                                 itertools.repeat(spool_dir), window=jobs * 2)
+            results = ((read_spool(spool_filename), checkpoint) for spool_filename, checkpoint in spools)
         else:
-            fp = open(filename)
-        for line in fp:
-            if not bitstreamRE[getServerAPI()].search(line):
-                # if no bitstream ID, don't go any further
-                continue
-            try:
-                p = log_parser(line)
-            except apache_log_parser.LineDoesntMatchException:
-                print("failed to parse '{0}'".format(line), file=sys.stderr)
-                continue
-            yield p
+            executor = None
+            results = ((parse_access_file(checkpoint, log_parser_name, filter_robots, chunk_size), checkpoint)
+                       for checkpoint in checkpoints)
+
+        try:
+            for batches, checkpoint in results:
+                count = 0
+                robot_counts = collections.Counter()
+                for rows, batch_robot_counts in batches:
+                    count += write_rows(db, ACCESS_INSERT, rows, chunk_size, prepare=insert_dimension_values)
+                    robot_counts.update(batch_robot_counts)
+                # the checkpoint is only up to date once its batches are consumed
+                print("parsed '{0}': {1} rows, {2} robot accesses".format(
+                    checkpoint['filename'], count, sum(robot_counts.values())))
+                add_robot_access_counts(db, robot_counts)
+                write_checkpoint(db, checkpoint)
+                db.commit()
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+
+def parse_access_file(checkpoint, log_parser_name, filter_robots=False, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Parse the log file associated with checkpoint starting at its offset.
+
+    Yield (rows, robot_counts) batches of at most chunk_size accesses, where
+    rows are (bitstream_id, ip, ts, useragent) tuples, ts being the access
+    time in seconds since the epoch, and robot_counts is a Counter of robot
+    accesses by (day, bitstream_id) if filter_robots is set.
+    The checkpoint is updated once the last batch is yielded."""
+    if checkpoint['offset'] > 0:
+        print("resuming '{0}' at offset {1}".format(checkpoint['filename'], checkpoint['offset']))
+    else:
+        print("parsing '{0}'".format(checkpoint['filename']))
+    log_parser = LOG_PARSERS[log_parser_name]()
+    rows = []
+    robot_counts = collections.Counter()
+    robot_count = 0
+    # if no bitstream ID, don't go any further
+    lines = read_lines(checkpoint['filename'], checkpoint, get_bitstream_bytes_pattern())
+    for access in parse_lines(lines, log_parser):
+        row = access_to_row(access)
+        if row is None:
+            continue
+        bitstream_id, _, ts, user_agent = row
+        if filter_robots and get_browser_type(user_agent) == 'Robot':
+            robot_counts[(ts - ts % SECONDS_PER_DAY, bitstream_id)] += 1
+            robot_count += 1
+        else:
+            rows.append(row)
+        if len(rows) + robot_count >= chunk_size:
+            yield rows, robot_counts
+            rows = []
+            robot_counts = collections.Counter()
+            robot_count = 0
+    if rows or robot_counts:
+        yield rows, robot_counts
+
+
+def spool_access_file(checkpoint, log_parser_name, filter_robots, chunk_size, spool_dir):
+    """Parse the log file associated with checkpoint like parse_access_file()
+    and pickle its batches one after the other into a file of spool_dir.
+
+    Return the name of the spool file and the updated checkpoint. This
+    function is called in worker processes by add_access_info()."""
+    fd, spool_filename = tempfile.mkstemp(suffix='.pickle', dir=spool_dir)
+    with os.fdopen(fd, 'wb') as fp:
+        for batch in parse_access_file(checkpoint, log_parser_name, filter_robots, chunk_size):
+            pickle.dump(batch, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    return spool_filename, checkpoint
+
+
+def read_spool(spool_filename):
+    """Yield the batches pickled by spool_access_file(), then remove the file."""
+    try:
+        with open(spool_filename, 'rb') as fp:
+            while True:
+                try:
+                    yield pickle.load(fp)
+                except EOFError:
+                    return
+    finally:
+        os.remove(spool_filename)
+
+
+def access_to_row(access):
+    """Return the (bitstream_id, ip, ts, useragent) row of a parsed access,
+    or None if it is not a bitstream download.
+
+    Requests that are not HTTP requests (for example TLS handshakes sent to
+    the HTTP port) are parsed without 'request_url_path'."""
+    req = access.get('request_url_path')
+    m = bitstreamRE[getServerAPI()].match(req) if req is not None else None
+    if not m:
+        return None
+
+    host = access['remote_ip']
+    user_agent = access['request_header_user_agent']
+    access_time = int(datetime.fromisoformat(access['time_received_utc_isoformat']).timestamp())
+    bitstream_id = m.group(1)
+    return (bitstream_id, host, access_time, user_agent)
+
+
+CHECKPOINT_HEAD_SIZE = 4096
+
+
+def read_head(filename):
+    """Return the first CHECKPOINT_HEAD_SIZE decompressed bytes of the log file."""
+    with (gzip.open if is_compressed(filename) else open)(filename, 'rb') as fp:
+        return fp.read(CHECKPOINT_HEAD_SIZE)
+
+
+def read_checkpoint(db, filename):
+    """Return the checkpoint of the given log file.
+
+    The checkpoint is a dictionary associating 'offset' with the
+    offset of the first decompressed byte not yet processed, and
+    'complete' with True once a compressed file is processed entirely.
+
+    The checkpoint of the file is looked up by device and inode, and
+    otherwise by checksum of its first decompressed bytes so that a log
+    file compressed by logrotate resumes where the uncompressed one
+    stopped. The offset is reset to 0 if the file was replaced (the
+    checksum of its first bytes changed) or truncated.
+    """
+    stat = os.stat(filename)
+    head = read_head(filename)
+    checkpoint = {
+        'dev': stat.st_dev,
+        'inode': stat.st_ino,
+        'head_size': len(head),
+        'head_sha256': hashlib.sha256(head).hexdigest(),
+        'size': stat.st_size,
+        'offset': 0,
+        'complete': False,
+        'filename': filename
+    }
+
+    def matches(head_size, head_sha256):
+        return head_size <= len(head) and hashlib.sha256(head[:head_size]).hexdigest() == head_sha256
+
+    row = db.execute("""select head_size, head_sha256, size, offset, complete from access_checkpoint
+                     where dev=? and inode=?""", (stat.st_dev, stat.st_ino)).fetchone()
+    if row is None or not matches(row[0], row[1]):
+        row = db.execute("""select head_size, head_sha256, size, offset, 0 from access_checkpoint
+                         where head_sha256=? order by offset desc limit 1""",
+                         (checkpoint['head_sha256'],)).fetchone()
+    if row is not None:
+        head_size, head_sha256, size, offset, complete = row
+        if is_compressed(filename):
+            checkpoint['offset'] = offset
+            checkpoint['complete'] = bool(complete) and size == stat.st_size
+        elif offset <= stat.st_size:
+            checkpoint['offset'] = offset
+    return checkpoint
+
+
+def is_checkpoint_complete(checkpoint):
+    """Return True if the log file associated with checkpoint does not
+    need to be read, uncompressed files may still grow."""
+    if is_compressed(checkpoint['filename']):
+        return checkpoint['complete']
+    return checkpoint['offset'] >= checkpoint['size']
+
+
+def write_checkpoint(db, checkpoint):
+    db.execute("""insert or replace into access_checkpoint(dev, inode, head_size,
+               head_sha256, size, offset, complete, filename)
+               values(:dev, :inode, :head_size, :head_sha256, :size, :offset, :complete, :filename)""",
+               checkpoint)
+
+
+def is_compressed(filename):
+    return os.path.splitext(filename)[1] == '.gz'
+
+
+# size of the blocks of decompressed data scanned at once
+READ_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def read_lines(filename, checkpoint, pattern):
+    """Yield the lines of the log file (possibly gzipped) matching the
+    bytes pattern starting at the checkpoint offset, and update the
+    offset once the file is read.
+
+    Lines are only decoded if they match. Uncompressed files are
+    mapped in memory and compressed ones are decompressed by blocks
+    of READ_BLOCK_SIZE bytes.
+
+    The last line of an uncompressed file is only read once complete,
+    it is expected to be still written."""
+    if is_compressed(filename):
+        with gzip.open(filename, 'rb') as fp:
+            # skip the bytes processed before compression
+            fp.seek(checkpoint['offset'])
+            remainder = b''
+            while True:
+                block = fp.read(READ_BLOCK_SIZE)
+                if not block:
+                    break
+                block = remainder + block
+                end = block.rfind(b'\n') + 1
+                yield from find_lines(block, 0, end, pattern)
+                remainder = block[end:]
+            yield from find_lines(remainder, 0, len(remainder), pattern)
+            checkpoint['offset'] = fp.tell()
+        checkpoint['complete'] = True
+        return
+
+    with open(filename, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size <= checkpoint['offset']:
+            return
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            end = data.rfind(b'\n', checkpoint['offset']) + 1
+            if end == 0:
+                return
+            yield from find_lines(data, checkpoint['offset'], end, pattern)
+            checkpoint['offset'] = end
+
+
+def find_lines(data, start, end, pattern):
+    """Yield the decoded lines of data[start:end] matching the bytes pattern."""
+    position = start
+    while True:
+        m = pattern.search(data, position, end)
+        if not m:
+            return
+        line_start = data.rfind(b'\n', position, m.start()) + 1 or position
+        line_end = data.find(b'\n', m.end(), end) + 1 or end
+        yield data[line_start:line_end].decode('utf-8', errors='replace')
+        position = line_end
+
+
+def get_bitstream_bytes_pattern():
+    """Return bytes pattern used to select log lines including a bitstream ID."""
+    return re.compile(bitstreamRE[getServerAPI()].pattern.encode())
+
+
+def parse_lines(lines, log_parser):
+    """Yield each parsed bitstream download event."""
+    for line in lines:
+        try:
+            p = log_parser(line)
+        except (apache_log_parser.LineDoesntMatchException, IndexError, ValueError):
+            # apache_log_parser raises IndexError or ValueError for some
+            # malformed fields, for example an access time without time zone
+            print("failed to parse '{0}'".format(line), file=sys.stderr)
+            continue
+        yield p
 
 
 def create_log_parser():
@@ -80,3 +470,65 @@ def create_log_parser():
     format_string = r'%a %l %u %t "%r" %>s %b "%{Referer}i" "%{User-Agent}i"'
     log_parser = apache_log_parser.make_parser(format_string)
     return log_parser
+
+
+# Regular expression matching the log format parsed by create_log_parser()
+# and capturing only the fields used in add_access_info(). It is stricter
+# than the one generated by apache_log_parser so that any line it matches
+# is parsed identically by both.
+IP_ADDR_REGEX = (r'(?:\d{1,3}\.){3}\d{1,3}'
+                 r'|(?:[0-9A-Fa-f]{0,4}:){2,7}(?:[0-9A-Fa-f]{1,4}|(?:\d{1,3}\.){3}\d{1,3})')
+FAST_LOG_LINE_RE = re.compile(
+    r'(' + IP_ADDR_REGEX + r') \S+ \S+ '
+    r'\[(\d{2})/(\w{3})/(\d{4}):(\d{2}):(\d{2}):(\d{2}) ([+-])(\d{2})00\] '
+    r'"(?:GET|HEAD|POST|OPTIONS|PUT|CONNECT|PATCH|PROPFIND|DELETE) (\S{1,10000}) HTTP/1\.[01]" '
+    r'(?:\d+|-) (?:\d+|-) "[^"]*" "([^"]*)"')
+
+MONTHS = {
+    'Jan': '01', 'Feb': '02', 'Mar': '03', 'Apr': '04', 'May': '05', 'Jun': '06',
+    'Jul': '07', 'Aug': '08', 'Sep': '09', 'Oct': '10', 'Nov': '11', 'Dec': '12'
+}
+
+
+def create_fast_log_parser():
+    """Create parser for apache log entries returning only the
+    'remote_ip', 'time_received_utc_isoformat', 'request_url_path'
+    and 'request_header_user_agent' fields.
+
+    Lines not matching FAST_LOG_LINE_RE (for example with a time zone
+    offset including minutes) are parsed using create_log_parser()."""
+    fallback_parser = create_log_parser()
+
+    def parse(line):
+        m = FAST_LOG_LINE_RE.match(line)
+        if not m or m.group(3) not in MONTHS:
+            return fallback_parser(line)
+        ip, day, month, year, hour, minute, second, sign, tz_hours, url, user_agent = m.groups()
+
+        if tz_hours == '00':
+            access_time = '{0}-{1}-{2}T{3}:{4}:{5}+00:00'.format(
+                year, MONTHS[month], day, hour, minute, second)
+        else:
+            offset = timedelta(hours=int(tz_hours)) * (1 if sign == '+' else -1)
+            access_time = (datetime(int(year), int(MONTHS[month]), int(day),
+                                    int(hour), int(minute), int(second)) - offset).isoformat() + '+00:00'
+
+        if url[0] == '/' and url[1:2] != '/' and ';' not in url and '#' not in url:
+            path = url.split('?', 1)[0]
+        else:
+            path = urlparse(url).path
+
+        return {
+            'remote_ip': ip,
+            'time_received_utc_isoformat': access_time,
+            'request_url_path': path,
+            'request_header_user_agent': user_agent
+        }
+
+    return parse
+
+
+LOG_PARSERS = {
+    'apache': create_log_parser,
+    'fast': create_fast_log_parser
+}
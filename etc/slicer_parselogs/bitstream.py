@@ -1,10 +1,16 @@
 from slicer_download import (
+    decodeRecordText,
     getServerAPI,
     progress,
     progress_end,
     ServerAPI
 )
 
+from slicer_parselogs import (
+    DEFAULT_CHUNK_SIZE,
+    write_rows
+)
+
 
 COLUMNS = [
     'bitstream_id',
@@ -31,6 +37,12 @@ def create_bitstream_table(db):
                 columns=','.join(COLUMNS[1:]))
         )
 
+        # checksum of the record in the records database, see add_bitstream_info_from_db()
+        columns = [row[1] for row in c.execute("pragma table_info(bsinfo)")]
+        if 'record_sha256' not in columns:
+            c.execute("alter table bsinfo add column record_sha256")
+        c.execute("create index if not exists bsinfo_record_sha256_idx on bsinfo(record_sha256)")
+
 
 def get_cleaned_up_record(record):
     if getServerAPI() == ServerAPI.Midas_v1:
@@ -72,15 +84,89 @@ def get_cleaned_up_record(record):
         }
 
 
-def add_bitstream_info(db, records):
+# expressions of the bsinfo columns given the decoded record 'r' and the
+# item 'item_id' of the records database, see add_bitstream_info_from_db()
+RECORD_COLUMN_EXPRESSIONS = {
+    ServerAPI.Midas_v1: {
+        'bitstream_id': "json_extract(r, '$.bitstreams[0].bitstream_id')",
+        'filename': "json_extract(r, '$.bitstreams[0].name')",
+        'os': "json_extract(r, '$.os')",
+        'arch': "json_extract(r, '$.arch')",
+        'product_name': "json_extract(r, '$.productname')",
+        'codebase': "json_extract(r, '$.codebase')",
+        'release': "iif(json_type(r, '$.release') is null, '', json_extract(r, '$.release'))",
+        'revision': "json_extract(r, '$.revision')",
+        'creation_date': "json_extract(r, '$.date_creation')",
+        'checkout_date': "json_extract(r, '$.checkoutdate')",
+        'size': "json_extract(r, '$.bitstreams[0].size')",
+    },
+    ServerAPI.Girder_v1: {
+        'bitstream_id': "item_id",
+        'filename': """json_extract(r, '$.meta.baseName') || '-' || json_extract(r, '$.meta.version')
+                       || '-' || json_extract(r, '$.meta.os') || '-' || json_extract(r, '$.meta.arch')
+                       || case json_extract(r, '$.meta.os')
+                            when 'linux' then '.tar.gz' when 'macosx' then '.dmg' when 'win' then '.exe'
+                            else '' end""",
+        'os': "json_extract(r, '$.meta.os')",
+        'arch': "json_extract(r, '$.meta.arch')",
+        'product_name': "json_extract(r, '$.meta.baseName')",
+        'codebase': "''",  # Not supported
+        'release': "iif(json_type(r, '$.meta.release') is null, '', json_extract(r, '$.meta.release'))",
+        'revision': "json_extract(r, '$.meta.revision')",
+        'creation_date': "json_extract(r, '$.meta.build_date')",
+        'checkout_date': "''",  # Not supported
+        'size': "json_extract(r, '$.size')",
+    },
+}
+
+
+def add_bitstream_info_from_db(db, records_db_filename):
+    """Add bitstream information of the records stored by slicer_getbuildinfo
+    in records_db_filename.
+
+    The columns are extracted from the records using a single statement,
+    only records whose checksum is not found in the 'record_sha256'
+    column are written. See get_cleaned_up_record()."""
+    print("populating 'bsinfo' table from '{0}'".format(records_db_filename))
+    expressions = RECORD_COLUMN_EXPRESSIONS[getServerAPI()]
+    db.create_function('decode_record', 1, decodeRecordText, deterministic=True)
+    db.execute("attach database ? as records", (records_db_filename,))
+    try:
+        with db as c:
+            # decode each record once, columns are extracted from the decoded
+            # records of the temporary table
+            c.execute(
+                'create temp table bsinfo_records as '
+                'select item_id, decode_record(record) as r, record_sha256 from records._ '
+                'where record_sha256 is null or record_sha256 not in ('
+                '  select record_sha256 from bsinfo where record_sha256 is not null)')
+            count = c.execute(
+                'insert or replace into bsinfo({columns}, record_sha256) '
+                'select {expressions}, record_sha256 from temp.bsinfo_records'.format(
+                    columns=','.join(COLUMNS),
+                    expressions=','.join(expressions[column] for column in COLUMNS))
+            ).rowcount
+            c.execute("drop table temp.bsinfo_records")
+        print("added or updated {0} rows".format(count))
+    finally:
+        db.execute("detach database records")
+
+
+def add_bitstream_info(db, records, chunk_size=DEFAULT_CHUNK_SIZE):
     print("populating 'bsinfo' table")
+    # commit per chunk in case we exit
+    write_rows(
+        db,
+        'insert or replace into bsinfo({columns}) '
+        'values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'.format(columns=','.join(COLUMNS)),
+        iter_bitstream_info(records),
+        chunk_size)
+
+    progress_end()
+
+
+def iter_bitstream_info(records):
     for index, record in enumerate(records, start=1):
         progress(index, len(records))
         cleaned = get_cleaned_up_record(record)
-        db.execute(
-            'insert or replace into bsinfo({columns}) '
-            'values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'.format(columns=','.join(COLUMNS)),
-            [cleaned[column] for column in COLUMNS])
-        db.commit()
-
-    progress_end()
+        yield [cleaned[column] for column in COLUMNS]
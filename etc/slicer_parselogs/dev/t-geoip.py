@@ -8,7 +8,7 @@ db = sqlite3.connect(sys.argv[1])
 geoip_reader = geoip2.database.Reader(sys.argv[2])
 geoip_lookup = geoip_reader.city
 with db as cur:
-    for row in db.execute('select ip from access'):
+    for row in db.execute('select ip from access join ip using(ip_id)'):
         ip = row[0]
         try:
             r = geoip_lookup(ip)
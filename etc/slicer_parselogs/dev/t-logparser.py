@@ -0,0 +1,61 @@
+"""Check that the fast and apache log parsers extract the same fields.
+
+Lines are parsed as in add_access_info(): lines that fail to parse are skipped,
+and any exception escaping parse_lines() or access_to_row() is reported as an error.
+
+Usage: t-logparser.py [LOG_FILE ...]
+
+If no log file is given, the corpus found next to this script is used.
+"""
+import gzip
+import os
+import sys
+
+from slicer_parselogs import access
+
+
+FIELDS = [
+    'remote_ip',
+    'time_received_utc_isoformat',
+    'request_url_path',
+    'request_header_user_agent'
+]
+
+
+def read_lines(filename):
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rt', errors='replace') as fp:
+        yield from fp
+
+
+def parse(log_parser, line):
+    """Return the fields and the row extracted from line, or None if it is skipped."""
+    for p in access.parse_lines([line], log_parser):
+        return {field: p.get(field) for field in FIELDS}, access.access_to_row(p)
+    return None
+
+
+filenames = sys.argv[1:] or [os.path.join(os.path.dirname(os.path.abspath(__file__)), 't-logparser-corpus.log')]
+
+apache_parser = access.create_log_parser()
+fast_parser = access.create_fast_log_parser()
+
+count = 0
+mismatches = 0
+errors = 0
+for filename in filenames:
+    for line in read_lines(filename):
+        count += 1
+        try:
+            expected = parse(apache_parser, line)
+            actual = parse(fast_parser, line)
+        except Exception as exception:
+            errors += 1
+            print("error for '{0}'\n  {1}: {2}".format(line.rstrip('\n'), type(exception).__name__, exception))
+            continue
+        if expected != actual:
+            mismatches += 1
+            print("mismatch for '{0}'\n  apache: {1}\n  fast:   {2}".format(line.rstrip('\n'), expected, actual))
+
+print("{0} lines compared, {1} mismatches, {2} errors".format(count, mismatches, errors))
+sys.exit(1 if mismatches or errors else 0)
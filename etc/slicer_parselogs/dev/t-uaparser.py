@@ -7,7 +7,7 @@ db = sqlite3.connect(sys.argv[1])
 
 
 with db as cur:
-    for row in db.execute('select useragent from uainfo'):
+    for row in db.execute('select useragent from uainfo join useragent using(useragent_id)'):
         ua = row[0]
         r = user_agent_parser.Parse(ua)
         # print(r)
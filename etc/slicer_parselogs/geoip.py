@@ -1,3 +1,7 @@
+import bisect
+import concurrent.futures
+import ipaddress
+
 import geoip2.database
 
 from slicer_download import (
@@ -5,65 +9,444 @@ from slicer_download import (
     progress_end
 )
 
+from slicer_parselogs import (
+    DEFAULT_CHUNK_SIZE,
+    get_meta,
+    map_bounded,
+    set_meta
+)
+
+
+IPINFO_COLUMNS = '''country_code, country_code3, country_name,
+            region_name, city, latitude, longitude'''
+
+# how the location of IPs is stored in the 'ipinfo' table
+GEOIP_GRANULARITIES = ['ip', 'network']
+
 
 def create_geoip_table(db):
     print("creating 'ipinfo' table")
     with db as c:
+        columns = [row[1] for row in c.execute("pragma table_info(ipinfo)")]
+        migrated = 'ip' in columns
+        if migrated:
+            migrate_geoip_table(c)
+
+        # no-op if 'ipinfo' is a view, see set_geoip_granularity()
+        c.execute(f'''create table if not exists
+            ipinfo (ip_id integer primary key, {IPINFO_COLUMNS});
+        ''')
+
+        # IPs not found in the GeoIP database or without location
         c.execute('''create table if not exists
-            ipinfo (ip primary key, country_code, country_code3, country_name,
-            region_name, city, latitude, longitude);
+            ipinfo_unresolved (ip_id integer primary key, geoip_build_epoch integer);
+        ''')
+        c.execute('''create index if not exists ipinfo_unresolved_epoch_idx
+            on ipinfo_unresolved(geoip_build_epoch)''')
+
+        # networks returned by GeoIP database lookups, the location
+        # is NULL for networks not found or without location
+        c.execute(f'''create table if not exists
+            geoip_network (network_id integer primary key, network, geoip_build_epoch integer,
+            {IPINFO_COLUMNS}, unique(geoip_build_epoch, network));
         ''')
+    return migrated
+
+
+def migrate_geoip_table(db):
+    """Convert the 'ipinfo' table keyed by IP into one keyed by
+    the integer key of the 'ip' table."""
+    print("migrating 'ipinfo' table")
+    db.execute("begin")
+    db.execute("alter table ipinfo rename to ipinfo_text")
+    db.execute("insert or ignore into ip(ip) select ip from ipinfo_text order by rowid")
+    db.execute(f"create table ipinfo (ip_id integer primary key, {IPINFO_COLUMNS})")
+    db.execute(f'''insert into ipinfo(ip_id, {IPINFO_COLUMNS})
+               select ip_id, {IPINFO_COLUMNS} from ipinfo_text join ip using(ip)''')
+    db.execute("drop table ipinfo_text")
+
+
+def get_geoip_granularity(db):
+    return get_meta(db, 'geoip_granularity', 'ip')
+
+
+def set_geoip_granularity(db, granularity):
+    """Store the location of IPs either per IP in the 'ipinfo' table, or
+    per network in the 'geoip_network' table.
+
+    With the 'network' granularity, the 'ip_network' table associates each
+    IP with its network and 'ipinfo' becomes a view joining both tables.
+    Switching to it drops the per IP locations, IPs are then looked up
+    again by the next add_geoip_info()."""
+    if granularity == get_geoip_granularity(db):
+        return
+    print(f"converting 'ipinfo' table to {granularity} granularity")
+    with db as c:
+        c.execute("begin")
+        if granularity == 'network':
+            c.execute("drop table ipinfo")
+            c.execute("create table ip_network (ip_id integer primary key, network_id integer)")
+            c.execute("create index ip_network_network_idx on ip_network(network_id)")
+            c.execute(f'''create view ipinfo as
+                select ip_id, {IPINFO_COLUMNS} from ip_network join geoip_network using(network_id)''')
+            set_meta(c, 'geoip_last_ip_id', -1)
+        else:
+            c.execute(f"create table ipinfo_ip (ip_id integer primary key, {IPINFO_COLUMNS})")
+            c.execute("insert into ipinfo_ip select * from ipinfo order by ip_id")
+            c.execute("drop view ipinfo")
+            c.execute("drop table ip_network")
+            c.execute("alter table ipinfo_ip rename to ipinfo")
+        set_meta(c, 'geoip_granularity', granularity)
+
+
+# IPs unresolved using a GeoIP database older than the current one
+UNRESOLVED_IPS_QUERY = """
+    select ip_id, ip from ipinfo_unresolved join ip using(ip_id)
+    where geoip_build_epoch < :build_epoch and ip_id > :last_ip_id
+    order by ip_id limit :limit
+"""
 
+# IPs never looked up
+NEW_IPS_QUERY = """
+    select ip_id, ip from ip
+    where ip_id > :last_ip_id
+    and not exists (select 1 from ipinfo where ipinfo.ip_id = ip.ip_id)
+    and not exists (select 1 from ipinfo_unresolved where ipinfo_unresolved.ip_id = ip.ip_id)
+    order by ip_id limit :limit
+"""
 
-def add_geoip_info(db, geoip_data_filename):
+
+def add_geoip_info(db, geoip_data_filename, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Add location of IPs to the 'ipinfo' table.
+
+    IPs without location are recorded in the 'ipinfo_unresolved' table
+    along with the build epoch of the GeoIP database, they are looked up
+    again only once a newer GeoIP database is used.
+
+    Other IPs are looked up only once, the 'ip' table is read by chunks
+    of chunk_size rows starting after the 'geoip_last_ip_id' metadata.
+    Results are committed per chunk.
+
+    Networks returned by the lookups are kept in the 'geoip_network' table,
+    IPs falling into a network already known for the current GeoIP database
+    are not looked up."""
     print("populating 'ipinfo' table")
 
     geoip_reader = geoip2.database.Reader(geoip_data_filename)
     geoip_lookup = geoip_reader.city  # use the city database
+    build_epoch = geoip_reader.metadata().build_epoch
 
-    ipCompleted = set()
-    ips = list(db.execute("select ip from access except select ip from ipinfo"))
-    for index, ip in enumerate(ips, start=1):
-        progress(index, len(ips))
-        ip = ip[0]
-        if ip in ipCompleted:
-            continue
+    # all locations come from this GeoIP database, see refresh_geoip_info()
+    if get_meta(db, 'geoip_build_epoch') is None and db.execute("select 1 from ipinfo").fetchone() is None:
+        set_meta(db, 'geoip_build_epoch', build_epoch)
 
-        try:
-            r = geoip_lookup(ip)
-        except geoip2.errors.AddressNotFoundError:
-            continue
+    networks = load_network_cache(db, build_epoch)
+    granularity = get_geoip_granularity(db)
 
-        if r.location.latitude is None:
-            continue
-        
-        try:
-            subdivision = r.subdivisions[0].names['en']
-        except (KeyError, IndexError):
-            subdivision = None
+    def add_chunk(ips):
+        add_geoip_info_chunk(db, geoip_lookup, build_epoch, ips, networks, granularity)
 
-        try:
-            city = r.city.names['en']
-        except (KeyError, IndexError):
-            city = None
+    for ips in iter_ip_chunks(db, UNRESOLVED_IPS_QUERY, -1, build_epoch, chunk_size):
+        add_chunk(ips)
+        db.commit()
 
-        try:
-            country = r.country.names['en']
-        except (KeyError, IndexError):
-            country = None
-
-        db.execute('''insert or replace into ipinfo(ip,
-                                        country_code, country_code3, country_name,
-                                        region_name, city, latitude, longitude)
-                                        values(?, ?, ?, ?, ?, ?, ?, ?);''',
-                                        (ip,
-                                        r.country.iso_code,
-                                        r.country.iso_code,  # was country_code3
-                                        country,
-                                        subdivision,
-                                        city,
-                                        float(r.location.latitude),
-                                        float(r.location.longitude)))
-        ipCompleted.add(ip)
-        db.commit()  # commit per record in case we exit
+    last_ip_id = get_meta(db, 'geoip_last_ip_id', -1)
+    total = db.execute("select count(1) from ip where ip_id > ?", (last_ip_id,)).fetchone()[0]
+    count = 0
+    for ips in iter_ip_chunks(db, NEW_IPS_QUERY, last_ip_id, build_epoch, chunk_size):
+        add_chunk(ips)
+        # IPs are added to the 'ip' table with increasing ip_id
+        set_meta(db, 'geoip_last_ip_id', ips[-1][0])
+        db.commit()  # commit per chunk in case we exit
+        count += len(ips)
+        progress(count, max(total, count))
     progress_end()
+
+    remove_unused_networks(db, build_epoch)
+    db.commit()
+
+
+def iter_ip_chunks(db, query, last_ip_id, build_epoch, chunk_size):
+    """Yield lists of (ip_id, ip) tuples returned by query, by increasing ip_id."""
+    while True:
+        ips = [tuple(row) for row in db.execute(query, {
+            'build_epoch': build_epoch,
+            'last_ip_id': last_ip_id,
+            'limit': chunk_size
+        })]
+        if not ips:
+            return
+        yield ips
+        last_ip_id = ips[-1][0]
+
+
+class NetworkCache:
+    """Sorted table of non-overlapping networks, per IP version.
+
+    Each network is associated with a (network_id, ip_info) tuple, where
+    ip_info is None for networks without location."""
+
+    def __init__(self):
+        # starts, ends and values of the networks sorted by start address
+        self.tables = {4: ([], [], []), 6: ([], [], [])}
+
+    def __len__(self):
+        return sum(len(starts) for starts, _, _ in self.tables.values())
+
+    def find(self, address):
+        starts, ends, values = self.tables[address.version]
+        address = int(address)
+        index = bisect.bisect_right(starts, address) - 1
+        if index >= 0 and address <= ends[index]:
+            return values[index]
+        return None
+
+    def add(self, network, value):
+        starts, ends, values = self.tables[network.version]
+        start = int(network.network_address)
+        index = bisect.bisect_left(starts, start)
+        starts.insert(index, start)
+        ends.insert(index, int(network.broadcast_address))
+        values.insert(index, value)
+
+
+def load_network_cache(db, build_epoch):
+    networks = NetworkCache()
+    rows = db.execute(f'''select network_id, network, {IPINFO_COLUMNS} from geoip_network
+                         where geoip_build_epoch = ?''', (build_epoch,))
+    for network_id, network, *ip_info in rows:
+        latitude = ip_info[5]
+        networks.add(ipaddress.ip_network(network), (network_id, tuple(ip_info) if latitude is not None else None))
+    return networks
+
+
+def remove_unused_networks(db, build_epoch):
+    """Remove networks of older GeoIP databases no longer referenced by the 'ip_network' table."""
+    if get_geoip_granularity(db) == 'network':
+        db.execute("""delete from geoip_network where geoip_build_epoch < ?
+                      and network_id not in (select network_id from ip_network)""", (build_epoch,))
+    else:
+        db.execute("delete from geoip_network where geoip_build_epoch < ?", (build_epoch,))
+
+
+def add_geoip_info_chunk(db, geoip_lookup, build_epoch, ips, networks, granularity='ip'):
+    resolved = []
+    unresolved = []
+    for ip_id, ip in ips:
+        network_id, ip_info = lookup_cached_ip_info(db, geoip_lookup, build_epoch, networks, ip)
+        if ip_info is None:
+            unresolved.append((ip_id, build_epoch))
+        elif granularity == 'network':
+            resolved.append((ip_id, network_id))
+        else:
+            resolved.append((ip_id,) + ip_info)
+    write_ip_info(db, granularity, resolved, unresolved)
+
+
+def write_ip_info(db, granularity, resolved, unresolved):
+    """Write the (ip_id, network_id) or (ip_id, ipinfo columns...) resolved rows
+    depending on granularity, and the (ip_id, build_epoch) unresolved rows."""
+    if granularity == 'network':
+        table = 'ip_network'
+        db.executemany("insert or replace into ip_network(ip_id, network_id) values(?, ?)", resolved)
+    else:
+        table = 'ipinfo'
+        db.executemany(f'''insert or replace into ipinfo(ip_id, {IPINFO_COLUMNS})
+                          values(?, ?, ?, ?, ?, ?, ?, ?);''', resolved)
+    db.executemany("delete from ipinfo_unresolved where ip_id = ?", [(row[0],) for row in resolved])
+    db.executemany(f"delete from {table} where ip_id = ?", [(row[0],) for row in unresolved])
+    db.executemany("""insert or replace into ipinfo_unresolved(ip_id, geoip_build_epoch)
+                      values(?, ?)""", unresolved)
+
+
+def lookup_cached_ip_info(db, geoip_lookup, build_epoch, networks, ip):
+    """Return the (network_id, ip_info) tuple associated with ip, looking
+    up the GeoIP database only if ip is not in a known network."""
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return None, None
+
+    value = networks.find(address)
+    if value is not None:
+        return value
+
+    network, ip_info = lookup_ip_network_info(geoip_lookup, ip)
+    if network is None:
+        return None, ip_info
+    return add_network(db, build_epoch, networks, network, ip_info)
+
+
+def add_network(db, build_epoch, networks, network, ip_info):
+    """Record the location of network in the 'geoip_network' table and in
+    networks, return the (network_id, ip_info) tuple associated with it."""
+    network_id = db.execute(f'''insert into geoip_network(network, geoip_build_epoch, {IPINFO_COLUMNS})
+                               values(?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                            (str(network), build_epoch) + (ip_info or (None,) * 7)).lastrowid
+    value = (network_id, ip_info)
+    networks.add(network, value)
+    return value
+
+
+# IPs with a location
+REFRESH_IPS_QUERY = f"""
+    select ip_id, ip, {IPINFO_COLUMNS} from ipinfo join ip using(ip_id)
+    where ip_id > :last_ip_id
+    order by ip_id limit :limit
+"""
+
+
+def refresh_geoip_info(db, geoip_data_filename, jobs=1, chunk_size=DEFAULT_CHUNK_SIZE, dry_run=False):
+    """Look up again the location of IPs in the 'ipinfo' table if the GeoIP
+    database is newer than the one recorded in the 'geoip_build_epoch' metadata.
+
+    The 'ipinfo' table is read by chunks of chunk_size rows, looked up in a
+    pool of jobs processes each with its own reader of the GeoIP database,
+    at most twice as many chunks as processes being read ahead. Only rows
+    whose location changed are written, committed per chunk. The metadata
+    is updated once all IPs are looked up."""
+    print("refreshing 'ipinfo' table")
+
+    build_epoch = geoip2.database.Reader(geoip_data_filename).metadata().build_epoch
+    last_build_epoch = get_meta(db, 'geoip_build_epoch')
+    if last_build_epoch is not None and last_build_epoch >= build_epoch:
+        print(f"skipping refresh: locations already come from GeoIP database built at {build_epoch}")
+        return
+
+    networks = load_network_cache(db, build_epoch)
+    granularity = get_geoip_granularity(db)
+
+    chunks = iter_ip_chunks(db, REFRESH_IPS_QUERY, -1, build_epoch, chunk_size)
+    if jobs > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=init_geoip_worker, initargs=(geoip_data_filename,))
+        results = map_bounded(executor, lookup_changed_ip_info, chunks, window=jobs * 2)
+    else:
+        executor = None
+        init_geoip_worker(geoip_data_filename)
+        results = map(lookup_changed_ip_info, chunks)
+
+    total = db.execute("select count(1) from ipinfo").fetchone()[0]
+    count = 0
+    updated_count = 0
+    unresolved_count = 0
+    try:
+        for ips_count, changed in results:
+            resolved = []
+            unresolved = []
+            for ip_id, network, ip_info in changed:
+                if ip_info is None:
+                    unresolved.append((ip_id, build_epoch))
+                elif dry_run:
+                    resolved.append((ip_id,))
+                elif granularity == 'network':
+                    network = ipaddress.ip_network(network)
+                    network_id, _ = networks.find(network.network_address) or add_network(
+                        db, build_epoch, networks, network, ip_info)
+                    resolved.append((ip_id, network_id))
+                else:
+                    resolved.append((ip_id,) + ip_info)
+
+            if not dry_run:
+                write_ip_info(db, granularity, resolved, unresolved)
+                db.commit()  # commit per chunk in case we exit
+
+            count += ips_count
+            updated_count += len(resolved)
+            unresolved_count += len(unresolved)
+            progress(count, max(total, count))
+        progress_end()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if not dry_run:
+        set_meta(db, 'geoip_build_epoch', build_epoch)
+        remove_unused_networks(db, build_epoch)
+        db.commit()
+
+    print(f"\nProcessed {count}/{total} rows")
+    print(f"\nUpdated {updated_count + unresolved_count} rows")
+    print(f"- {updated_count} with location updated")
+    print(f"- {unresolved_count} without location")
+
+    if dry_run:
+        print("Dry-run successful! No actual changes were made.")
+
+
+# GeoIP database lookup and networks of the current process, see init_geoip_worker()
+_geoip_lookup = None
+_geoip_networks = None
+
+
+def init_geoip_worker(geoip_data_filename):
+    global _geoip_lookup, _geoip_networks
+    # memory-mapped database shared by the processes through the page cache
+    reader = geoip2.database.Reader(geoip_data_filename, mode=geoip2.database.MODE_MMAP)
+    _geoip_lookup = reader.city
+    _geoip_networks = NetworkCache()
+
+
+def lookup_changed_ip_info(ips):
+    """Look up the (ip_id, ip, ipinfo columns...) ips rows.
+
+    Return the number of rows along with the (ip_id, network, ip_info)
+    tuples of the IPs whose location changed."""
+    changed = []
+    for ip_id, ip, *current_ip_info in ips:
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            network, ip_info = None, None
+        else:
+            network, ip_info = _geoip_networks.find(address) or (None, None)
+            if network is None:
+                network, ip_info = lookup_ip_network_info(_geoip_lookup, ip)
+                if network is not None:
+                    _geoip_networks.add(network, (network, ip_info))
+
+        if ip_info != tuple(current_ip_info):
+            changed.append((ip_id, network and str(network), ip_info))
+    return len(ips), changed
+
+
+def lookup_ip_network_info(geoip_lookup, ip):
+    """Return the network containing ip along with its ipinfo columns.
+
+    The network is None if unknown, the ipinfo columns are None if
+    ip is not found or has no location."""
+    try:
+        r = geoip_lookup(ip)
+    except geoip2.errors.AddressNotFoundError as e:
+        # network is available since geoip2 4.2
+        network = getattr(e, 'network', None)
+        return network, None
+    except ValueError:
+        return None, None
+
+    network = r.traits.network
+    if r.location.latitude is None:
+        return network, None
+
+    try:
+        subdivision = r.subdivisions[0].names['en']
+    except (KeyError, IndexError):
+        subdivision = None
+
+    try:
+        city = r.city.names['en']
+    except (KeyError, IndexError):
+        city = None
+
+    try:
+        country = r.country.names['en']
+    except (KeyError, IndexError):
+        country = None
+
+    return network, (r.country.iso_code,
+                     r.country.iso_code,  # was country_code3
+                     country,
+                     subdivision,
+                     city,
+                     float(r.location.latitude),
+                     float(r.location.longitude))
@@ -1,6 +1,8 @@
 import re
+import sys
 
 from . import countries
+from . import get_meta, set_meta
 
 ''' bitstream[id] = {
      os: {mac,win,linux}
@@ -33,16 +35,52 @@ BitstreamQuery = """
 AccessQuery =  """
     select bsinfo.bitstream_id, ipinfo.country_code, 
     ipinfo.latitude, ipinfo.longitude, 
-    access.ts 
+    strftime('%Y-%m-%dT%H:%M', access.ts, 'unixepoch') as ts 
     from access 
-        join bsinfo on access.bitstream_id = bsinfo.bitstream_id 
-        join ipinfo on access.ip = ipinfo.ip 
-        join uainfo on access.useragent = uainfo.useragent 
+        join bitstream on access.bs_id = bitstream.bs_id 
+        join bsinfo on bitstream.bitstream_id = bsinfo.bitstream_id 
+        join ipinfo on access.ip_id = ipinfo.ip_id 
+        join uainfo on access.useragent_id = uainfo.useragent_id 
     where uainfo.browser_type = 'Browser' 
-    group by access.ip, bsinfo.bitstream_id 
+    and access.ts >= :since and access.ts < :until 
+    group by access.ip_id, bsinfo.bitstream_id 
     order by access.ts
 """
 
+# first access of each IP to each bitstream, see update_access_first()
+FirstAccessQuery = """
+    select bsinfo.bitstream_id, ipinfo.country_code,
+    ipinfo.latitude, ipinfo.longitude,
+    strftime('%Y-%m-%dT%H:%M', access_first.ts, 'unixepoch') as ts
+    from access_first
+        join bitstream on access_first.bs_id = bitstream.bs_id
+        join bsinfo on bitstream.bitstream_id = bsinfo.bitstream_id
+        join ipinfo on access_first.ip_id = ipinfo.ip_id
+    order by access_first.ts
+"""
+
+AccessFirstUpsert = """
+    insert into access_first(ip_id, bs_id, ts)
+    select access.ip_id, access.bs_id, min(access.ts)
+    from access
+        join uainfo on access.useragent_id = uainfo.useragent_id
+    where access.rowid > :last_rowid and access.rowid <= :max_rowid
+    and uainfo.browser_type = 'Browser'
+    group by access.ip_id, access.bs_id
+    on conflict(ip_id, bs_id) do update set ts = min(ts, excluded.ts)
+"""
+
+# first access since the last update whose user agent is not classified yet
+FirstUnclassifiedAccessQuery = """
+    select min(access.rowid) from access
+    where access.rowid > :last_rowid
+    and not exists (select 1 from uainfo where uainfo.useragent_id = access.useragent_id)
+"""
+
+# bounds of the access times (in seconds since the epoch) used by default
+MIN_ACCESS_TIME = 0
+MAX_ACCESS_TIME = 2 ** 62
+
 EUCountryInfo = ['European Union', 'Western Europe', 'Europe']
 
 BitTable = {
@@ -51,9 +89,55 @@ BitTable = {
 }
 
 
-def get_download_stats_data(db):
+def create_access_first_table(db):
+    print("creating 'access_first' table")
+    with db as c:
+        c.execute('''create table if not exists
+            access_first (ip_id integer, bs_id integer, ts integer, primary key(ip_id, bs_id))
+        ''')
+        c.execute("create index if not exists access_first_ts_idx on access_first(ts)")
+    return False
+
+
+def update_access_first(db):
+    """Add the browser accesses inserted in the 'access' table since the
+    'access_first_last_rowid' metadata to the 'access_first' table.
+
+    Accesses are only added up to the first one whose user agent is not
+    classified yet, the next update resumes from there. See
+    reset_access_first() if the classification changes."""
+    last_rowid = get_meta(db, 'access_first_last_rowid', 0)
+    max_rowid = db.execute("select max(rowid) from access").fetchone()[0] or 0
+    unclassified_rowid = db.execute(FirstUnclassifiedAccessQuery, {'last_rowid': last_rowid}).fetchone()[0]
+    if unclassified_rowid is not None:
+        print(f"user agents of accesses from rowid {unclassified_rowid} are not classified yet, "
+              "skipping them in 'access_first' table", file=sys.stderr)
+        max_rowid = unclassified_rowid - 1
+    if max_rowid <= last_rowid:
+        return
+    print("updating 'access_first' table")
+    with db as c:
+        c.execute(AccessFirstUpsert, {'last_rowid': last_rowid, 'max_rowid': max_rowid})
+        set_meta(c, 'access_first_last_rowid', max_rowid)
+
+
+def reset_access_first(db):
+    """Empty the 'access_first' table, it is rebuilt by the next update_access_first()."""
+    print("resetting 'access_first' table")
+    with db as c:
+        c.execute("delete from access_first")
+        set_meta(c, 'access_first_last_rowid', 0)
+
+
+def get_download_stats_data(db, since=None, until=None):
+    """Return the download stats data.
+
+    If set, since and until restrict the accesses to the ones
+    in [since, until), they are expressed in seconds since the epoch.
+    Otherwise, accesses are read from the 'access_first' table,
+    see update_access_first()."""
     bitstream = build_bitstream_table(db)
-    access, location = build_access_table(db)
+    access, location = build_access_table(db, since, until)
     country_code = build_country_code_table(db)
 
     return {
@@ -99,15 +183,24 @@ def build_bitstream_table(db):
     return bitstream_table
 
 
-def build_access_table(db):
+def build_access_table(db, since=None, until=None):
     access_table = []
     location_cache = []
     location_lookup = {}
     location_id = 0
     
     with db as cur:
-        print("executing 'AccessQuery'")
-        for row in cur.execute(AccessQuery):
+        if since is None and until is None:
+            print("executing 'FirstAccessQuery'")
+            rows = cur.execute(FirstAccessQuery)
+        else:
+            print("executing 'AccessQuery'")
+            time_range = {
+                'since': MIN_ACCESS_TIME if since is None else since,
+                'until': MAX_ACCESS_TIME if until is None else until
+            }
+            rows = cur.execute(AccessQuery, time_range)
+        for row in rows:
             locs = format_latlng(row['latitude'], row['longitude'])
             try:
                 loci = location_lookup[locs]
@@ -117,7 +210,7 @@ def build_access_table(db):
                 location_lookup[locs] = loci
                 location_cache.append(locs)
             access_table.append((row['bitstream_id'],
-                    row['ts'][0:16],
+                    row['ts'],
                     row['country_code'],
                     loci))
     return (access_table, location_cache)
@@ -1,3 +1,6 @@
+import concurrent.futures
+import functools
+import importlib.metadata
 import json
 import os
 from datetime import date
@@ -9,15 +12,48 @@ from slicer_download import (
 )
 from ua_parser import user_agent_parser
 
+from slicer_parselogs import DEFAULT_CHUNK_SIZE, map_bounded
+from slicer_parselogs.slicerstats import reset_access_first
+
+
+UAINFO_COLUMNS = "browser_type, ua_name, os_name, os_family"
+
+# user agents are classified again when ua-parser and its regexes are updated
+UA_PARSER_VERSION = importlib.metadata.version('ua-parser')
+
 
 def create_useragent_table(db):
     print("creating 'uainfo' table")
     with db as c:
-        c.execute('''create table if not exists
-            uainfo (useragent primary key, 
-                    browser_type, ua_name, os_name, os_family)
+        columns = [row[1] for row in c.execute("pragma table_info(uainfo)")]
+        migrated = 'useragent' in columns
+        if migrated:
+            migrate_useragent_table(c)
+
+        c.execute(f'''create table if not exists
+            uainfo (useragent_id integer primary key, {UAINFO_COLUMNS})
         ''')
 
+        # classification of user agents per ua-parser version
+        c.execute(f'''create table if not exists
+            uainfo_memo (useragent_id integer, ua_parser_version, {UAINFO_COLUMNS},
+            primary key(useragent_id, ua_parser_version))
+        ''')
+    return migrated
+
+
+def migrate_useragent_table(db):
+    """Convert the 'uainfo' table keyed by user agent into one keyed by
+    the integer key of the 'useragent' table."""
+    print("migrating 'uainfo' table")
+    db.execute("begin")
+    db.execute("alter table uainfo rename to uainfo_text")
+    db.execute("insert or ignore into useragent(useragent) select useragent from uainfo_text order by rowid")
+    db.execute(f"create table uainfo (useragent_id integer primary key, {UAINFO_COLUMNS})")
+    db.execute(f'''insert into uainfo(useragent_id, {UAINFO_COLUMNS})
+               select useragent_id, {UAINFO_COLUMNS} from uainfo_text join useragent using(useragent)''')
+    db.execute("drop table uainfo_text")
+
 
 def get_browser_type_compat(rec):
     family = rec['device']['family']
@@ -29,6 +65,12 @@ def get_browser_type_compat(rec):
     return 'MobileBrowser'
 
 
+@functools.lru_cache(maxsize=None)
+def get_browser_type(user_agent):
+    """Return the browser type of user_agent, memoized for the lifetime of the process."""
+    return get_browser_type_compat(user_agent_parser.Parse(user_agent))
+
+
 def pretty_os(rec):
     os = rec['os']
     return user_agent_parser.PrettyOS(os['family'],
@@ -49,112 +91,198 @@ def parse_useragent(user_agent):
         "os_family": ua_rec['os']['family']}
 
 
-def add_useragent_info_row(db, fields):
-    db.execute("""insert or replace into uainfo(useragent,
-                browser_type, ua_name, os_name, os_family)
-                values(:useragent, :browser_type, :ua_name, :os_name, :os_family)""",
-                fields)
+# user agents not classified with the installed ua-parser version
+UNCLASSIFIED_USERAGENTS_QUERY = """
+    select useragent_id, useragent from useragent
+    where useragent_id > :last_useragent_id and {condition}
+    and not exists (select 1 from uainfo_memo
+                    where uainfo_memo.useragent_id = useragent.useragent_id
+                    and ua_parser_version = :ua_parser_version)
+    order by useragent_id limit :limit
+"""
+
+
+def classify_useragents(db, condition, jobs=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Classify user agents matching condition into the 'uainfo_memo' table.
+
+    User agents already classified with the installed ua-parser version are
+    skipped, others are parsed by chunks of chunk_size in a pool of jobs
+    processes, at most twice as many chunks as processes being read ahead.
+    Results are committed per chunk."""
+    chunks = iter_unclassified_useragents(db, condition, chunk_size)
+    if jobs > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+        results = map_bounded(executor, parse_useragent_chunk, chunks, window=jobs * 2)
+    else:
+        executor = None
+        results = map(parse_useragent_chunk, chunks)
+
+    total = db.execute(f"select count(1) from useragent where {condition}").fetchone()[0]
+    count = 0
+    try:
+        for uas_count, rows in results:
+            db.executemany(f'''insert or replace into uainfo_memo(useragent_id, ua_parser_version, {UAINFO_COLUMNS})
+                              values(?, ?, ?, ?, ?, ?)''', rows)
+            db.commit()  # commit per chunk in case we exit
+            count += uas_count
+            progress(count, max(total, count))
+        progress_end()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def iter_unclassified_useragents(db, condition, chunk_size):
+    """Yield lists of (useragent_id, useragent) tuples by increasing useragent_id."""
+    last_useragent_id = -1
+    while True:
+        uas = [tuple(row) for row in db.execute(UNCLASSIFIED_USERAGENTS_QUERY.format(condition=condition), {
+            'last_useragent_id': last_useragent_id,
+            'ua_parser_version': UA_PARSER_VERSION,
+            'limit': chunk_size
+        })]
+        if not uas:
+            return
+        yield uas
+        last_useragent_id = uas[-1][0]
+
+
+def parse_useragent_chunk(uas):
+    """Return the number of (useragent_id, useragent) uas along with
+    the 'uainfo_memo' rows of the ones successfully parsed."""
+    rows = []
+    for useragent_id, user_agent in uas:
+        ua_fields = parse_useragent(user_agent)
+        if ua_fields is None:
+            continue
+        rows.append((useragent_id, UA_PARSER_VERSION, ua_fields['browser_type'], ua_fields['ua_name'],
+                     ua_fields['os_name'], ua_fields['os_family']))
+    return len(uas), rows
 
 
-def add_useragent_info(db):
+def add_useragent_info(db, jobs=1, chunk_size=DEFAULT_CHUNK_SIZE):
     print("populating 'uainfo' table")
-    ua_completed = set()
-    uas = list(db.execute("select useragent from access except select useragent from uainfo"))
-    for index, ua in enumerate(uas, start=1):
-        progress(index, len(uas))
-        user_agent = ua[0]
-        if user_agent in ua_completed:
-            continue
-        ua_fields = parse_useragent(user_agent);
-        if ua_fields is None:
-            continue
-        add_useragent_info_row(db, ua_fields)
-        ua_completed.add(user_agent)
-        db.commit() # commit per record in case we exit
-    progress_end()
+    condition = "useragent_id not in (select useragent_id from uainfo)"
+    classify_useragents(db, condition, jobs, chunk_size)
+    with db as c:
+        c.execute(f'''insert into uainfo(useragent_id, {UAINFO_COLUMNS})
+                     select useragent_id, {UAINFO_COLUMNS} from uainfo_memo
+                     where ua_parser_version = ? and {condition}''', (UA_PARSER_VERSION,))
+
 
+# user agents whose classification differs from the one of the installed ua-parser version
+UPDATED_USERAGENTS_QUERY = """
+    select useragent_id, useragent,
+           uainfo.browser_type, uainfo.ua_name, uainfo.os_name, uainfo.os_family,
+           memo.browser_type, memo.ua_name, memo.os_name, memo.os_family
+    from uainfo join useragent using(useragent_id) join uainfo_memo memo using(useragent_id)
+    where useragent_id > :last_useragent_id and memo.ua_parser_version = :ua_parser_version
+    and (uainfo.browser_type is not memo.browser_type or uainfo.ua_name is not memo.ua_name
+         or uainfo.os_name is not memo.os_name or uainfo.os_family is not memo.os_family)
+    order by useragent_id limit :limit
+"""
 
-def update_useragent_info(dbfile, dry_run=True):
+UAINFO_FIELDS = [column.strip() for column in UAINFO_COLUMNS.split(",")]
+
+
+def update_useragent_info(dbfile, dry_run=True, jobs=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Classify again the user agents of the 'uainfo' table and update the
+    rows whose classification changed with the installed ua-parser version.
+
+    See classify_useragents(), the 'uainfo_memo' table is updated even
+    if dry_run is set so that the actual update reuses the classification.
+
+    Changed rows are read by chunks of chunk_size rows, each written as a
+    [ua_fields, updated_ua_fields] line of a NDJSON file and counted in the
+    update stats displayed at the end."""
 
     if not os.path.isfile(dbfile):
         print(f"Database file {dbfile} does not exist")
         return
 
-    updated_rows_file = os.path.join(os.path.dirname(dbfile), f"download-stats-useragent-updates-{date.today()}.json")
+    updated_rows_file = os.path.join(os.path.dirname(dbfile), f"download-stats-useragent-updates-{date.today()}.ndjson")
 
-    with openDb(dbfile) as db:
+    with openDb(dbfile) as db, open(updated_rows_file, 'w') as fp:
         print("update 'uainfo' table")
 
-        updatedRows = []
-
-        uas = list(db.execute("select useragent, browser_type, ua_name, os_name, os_family from uainfo"))
-        for index, ua in enumerate(uas, start=1):
-            progress(index, len(uas))
-            ua_fields = {key: ua[key] for key in ua.keys()}
-            updated_ua_fields = parse_useragent(ua[0]);
-            if updated_ua_fields is None:
-                continue
-
-            if ua_fields != updated_ua_fields:
-                updatedRows.append((ua_fields, updated_ua_fields))
+        classify_useragents(db, "useragent_id in (select useragent_id from uainfo)", jobs, chunk_size)
+
+        fields = ["useragent"] + UAINFO_FIELDS
+        update_stats = create_useragent_info_update_stats()
+        last_useragent_id = -1
+        while True:
+            rows = [tuple(row) for row in db.execute(UPDATED_USERAGENTS_QUERY, {
+                'last_useragent_id': last_useragent_id,
+                'ua_parser_version': UA_PARSER_VERSION,
+                'limit': chunk_size
+            })]
+            if not rows:
+                break
+
+            updates = []
+            for row in rows:
+                ua_fields = dict(zip(fields, row[1:6]))
+                updated_ua_fields = dict(zip(fields, row[1:2] + row[6:10]))
+                fp.write(json.dumps([ua_fields, updated_ua_fields], separators=(',', ':')) + "\n")
+                add_useragent_info_update_stats(update_stats, ua_fields, updated_ua_fields)
+                updates.append(row[6:10] + row[0:1])
 
             if not dry_run:
-                add_useragent_info_row(db, updated_ua_fields)
-
-        progress_end()
+                db.executemany("""update uainfo set browser_type = ?, ua_name = ?, os_name = ?, os_family = ?
+                                  where useragent_id = ?""", updates)
+                db.commit()  # commit per chunk in case we exit
+            last_useragent_id = rows[-1][0]
 
         if not dry_run:
-            db.commit()
+            if update_stats["all"]:
+                # accesses are aggregated only for browsers
+                reset_access_first(db)
+            with db as c:
+                # classification of older ua-parser versions is not needed anymore
+                c.execute("delete from uainfo_memo where ua_parser_version != ?", (UA_PARSER_VERSION,))
             print("Saved {0}".format(dbfile))
 
-        print(f"\nProcessed {index}/{len(uas)} rows")
+        total = db.execute("select count(1) from uainfo").fetchone()[0]
+        print(f"\nProcessed {total} rows")
 
-        with open(updated_rows_file, 'w+') as fp:
-            json.dump(updatedRows, fp, separators=(',', ':'), indent=2)
+    print(f"Written {updated_rows_file}")
 
-        print(f"Written {updated_rows_file}")
+    if dry_run:
+        print("Dry-run successful! No actual changes were made.")
 
-        if dry_run:
-            print("Dry-run successful! No actual changes were made.")
+    display_useragent_info_update_stats(update_stats, field_details=True, useragent_details=False)
 
-        update_stats = read_useragent_info_update_stats(updated_rows_file)
-        display_useragent_info_update_stats(update_stats, field_details=True, useragent_details=False)
 
+def create_useragent_info_update_stats(useragent_details=False):
+    """Return update stats counting changes per field and per pair of values,
+    see add_useragent_info_update_stats().
 
-def read_useragent_info_update_stats(update_file):
-    if not os.path.isfile(update_file):
-        print(f"Update file {update_file} does not exist")
-        return
-
-    per_field = {
-        "browser_type": [],
-        "ua_name": [],
-        "os_name": [],
-        "os_family": [],
+    If useragent_details is set, the user agents of each pair are also collected."""
+    return {
+        "all": 0,
+        "count": {field: 0 for field in UAINFO_FIELDS},
+        "changes": {field: {} for field in UAINFO_FIELDS},
+        "useragents": {field: {} for field in UAINFO_FIELDS} if useragent_details else None,
     }
 
-    with open(update_file) as fp:
-        update_data = json.load(fp)
-
-        for ua_fields, updated_ua_fields in update_data:
-            for field in per_field.keys():
-                value = ua_fields[field]
-                updated_value = updated_ua_fields[field]
-                if value != updated_value:
-                    per_field[field].append((value, updated_value, ua_fields["useragent"]))
-
-    per_field_count = {field: len(per_field[field]) for field in per_field}
-
-    per_field_changes = {}
-    for field in per_field.keys():
-        per_field_changes[field]= {}
-        for value, updated_value, useragent in per_field[field]:
-            per_field_changes[field].setdefault(value, []).append((updated_value, useragent))
 
-    return {"all": len(update_data), "count": {**per_field_count}, "changes": {**per_field_changes}}
+def add_useragent_info_update_stats(stats, ua_fields, updated_ua_fields):
+    stats["all"] += 1
+    for field in UAINFO_FIELDS:
+        value = ua_fields[field]
+        updated_value = updated_ua_fields[field]
+        if value == updated_value:
+            continue
+        stats["count"][field] += 1
+        changes = stats["changes"][field].setdefault(value, {})
+        changes[updated_value] = changes.get(updated_value, 0) + 1
+        if stats["useragents"] is not None:
+            stats["useragents"][field].setdefault((value, updated_value), []).append(ua_fields["useragent"])
 
 
 def display_useragent_info_update_stats(stats, field_details=False, useragent_details=False):
+    """Display update stats, useragent_details requires stats collecting
+    user agents, see create_useragent_info_update_stats()."""
 
     print(f"\nUpdated {stats['all']} rows")
     for field in stats['count']:
@@ -170,10 +298,8 @@ def display_useragent_info_update_stats(stats, field_details=False, useragent_de
 
             print(f"\n<details><summary>{field}</summary><pre>")
             for value in changes:
-                updated_values = [value for value, _ in changes[value]]
-                updated_uas = [useragent for _, useragent in changes[value]]
-                for updated_value in set(updated_values):
-                    print(f"{value} -> {updated_value}: {updated_values.count(updated_value)}")
+                for updated_value, count in changes[value].items():
+                    print(f"{value} -> {updated_value}: {count}")
             print("</pre></details>")
 
     if useragent_details:
@@ -182,21 +308,16 @@ def display_useragent_info_update_stats(stats, field_details=False, useragent_de
 
         selected_fields = ["browser_type"]
 
-        for field in stats['changes']:
-            changes = stats['changes'][field]
+        for field in stats['useragents']:
             if field not in selected_fields:
                 continue
 
             print(f"\n### {field}")
 
-            for value in changes:
-                updated_values = [value for value, _ in changes[value]]
-                updated_uas = [useragent for _, useragent in changes[value]]
-                for updated_value in set(updated_values):
-                    if field in selected_fields:
-                        section = f"{value} -> {updated_value}: {updated_values.count(updated_value)}"
-                        print(f"\n<!-- {section} -->")
-                        print(f"\n<details><summary>{section}</summary><pre>")
-                        for updated_ua in updated_uas:
-                            print(f"{updated_ua}")
-                        print("</pre></details>")
+            for (value, updated_value), updated_uas in stats['useragents'][field].items():
+                section = f"{value} -> {updated_value}: {len(updated_uas)}"
+                print(f"\n<!-- {section} -->")
+                print(f"\n<details><summary>{section}</summary><pre>")
+                for updated_ua in updated_uas:
+                    print(f"{updated_ua}")
+                print("</pre></details>")
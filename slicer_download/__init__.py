@@ -1,14 +1,28 @@
+import aiohttp
+import asyncio
+import ctypes
+import ctypes.util
+import hashlib
+import itertools
 import json
+import logging
 import os
-import requests
+import re
+import select
 import sqlite3
+import struct
 import sys
-import urllib.error
-import urllib.parse
-import urllib.request
+import threading
+import time
+import zlib
 
 from enum import Enum
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 class ServerAPI(Enum):
     Midas_v1 = 1
@@ -20,34 +34,498 @@ def getServerAPI():
 
 
 def getServerAPIUrl():
+    """Return the base URL of the packages server API.
+
+    The ``SLICER_DOWNLOAD_SERVER_API_URL`` environment variable overrides the default
+    URL associated with :func:`getServerAPI`, e.g. to use a local stand-in server.
+    """
+    url = os.getenv("SLICER_DOWNLOAD_SERVER_API_URL")
+    if url:
+        return url.rstrip("/")
     return {
         ServerAPI.Midas_v1: "http://slicer.kitware.com/midas3/api/json",
         ServerAPI.Girder_v1: "https://slicer-packages.kitware.com/api/v1",
     }[getServerAPI()]
 
 
-def getMidasRecordsFromURL():
+STABILITY_CHOICES = (
+    'release',
+    'nightly',
+    'any'
+)
+
+
+def getRecordField(record, key):
+    """Return the value of a specific field in the record.
+
+    Given a record and the field key, this function returns the value of the requested field.
+    Depending on the server API used, the key is mapped to a field in the database record.
+    See :func:`slicer_download_server.recordsMatchingAllOSAndStability` and
+    :func:`slicer_download_server.getBestMatching`.
+
+    :param record: A dictionary with fields and values.
+    :param key: The field key.
+
+    :return: The value of the field in the record, or None if the field is not present.
+    """
+    if getServerAPI() == ServerAPI.Midas_v1:
+        if key == 'bitstream_id':
+            return record['bitstreams'][0]['bitstream_id']
+        else:
+            return record[key]
+
+    elif getServerAPI() == ServerAPI.Girder_v1:
+        if key == 'os':
+            return record['meta']['os']
+        elif key == 'revision':
+            return record['meta']['revision']
+        elif key == 'arch':
+            return record['meta']['arch']
+        elif key == 'date_creation':
+            return record['meta']['build_date']
+        elif key == 'checkoutdate':
+            return None  # Not supported
+        elif key == 'release':
+            return record['meta'].get('release', '')
+        elif key == 'pre_release':
+            return record['meta'].get('pre_release', 'False')
+        elif key == 'submissiontype':
+            return 'release' if record['meta'].get('release') else 'nightly'
+        elif key == 'bitstream_id':
+            return record['_id']
+
+
+def recordMatchesStability(record, stability):
+    """Return True if the record matches the provided stability.
+
+    A given record matches the "nightly" stability if its submissiontype is "nightly".
+
+    A given record matches the "release" stability under these two conditions:
+    * its "release" field has been set
+    * its "pre_release" field does not evaluate to True
+
+    Any record matches the "any" stability.
+
+    :param stability: stability to be matched. It should be one of the supported choices in :const:`STABILITY_CHOICES`.
+    """
+    if stability == 'nightly':
+        return getRecordField(record, 'submissiontype') == 'nightly'
+    if stability == 'release':
+        return getRecordField(record, 'release') != "" and not toBool(getRecordField(record, 'pre_release'))
+
+    return True
+
+
+# regex patterns for extracting version information.
+# this looks ugly because we need to be able to accept versions like:
+# 4.5.0, 4.5.0-1, 4.5.0-rc2, 4.5.0-gamma, and so forth
+VersionWithDateRE = re.compile(r'^[A-z]+-([-\d.a-z]+)-(\d{4}-\d{2}-\d{2})')
+VersionRE = re.compile(r'^[A-z]+-([-\d.a-z]+)-(macosx|linux|win+)')
+VersionFullRE = re.compile(r'^([-\d.a-z]+)-(\d{4}-\d{2}-\d{2})')
+VersionXyzRE = re.compile(r'^(\d+\.\d+\.\d+)$')
+
+
+def getVersion(record):
+    """Extract version information from the given record.
+
+    If the ``release`` key is found, returns the associated value.
+
+    Otherwise, it returns the version extracted from the value associated
+    with the ``name`` key for :const:`ServerAPI.Midas_v1` or the ``meta.version``
+    key for :const:`ServerAPI.Girder_v1`.
+
+    For :const:`ServerAPI.Midas_v1`, version extraction is attempted using
+    first the :const:`VersionWithDateRE` pattern and then the :const:`VersionRE`
+    pattern.
+
+    For :const:`ServerAPI.Girder_v1`, version extraction is attempted using
+    first the :const:`VersionFullRE` pattern and then the :const:`VersionXyzRE`
+    pattern.
+
+    If the value associated with the selected key does not match any of the
+    regular expressions, it returns ``None``.
+
+    See :func:`getRecordField`.
+    """
+    if getRecordField(record, 'release'):
+        return getRecordField(record, 'release')
+
+    match = None
+
+    if getServerAPI() == ServerAPI.Midas_v1:
+        match = VersionWithDateRE.match(record['name'])
+        if not match:
+            match = VersionRE.match(record['name'])
+
+    elif getServerAPI() == ServerAPI.Girder_v1:
+        match = VersionFullRE.match(record['meta']['version'])
+        if not match:
+            match = VersionXyzRE.match(record['meta']['version'])
+
+    if not match:
+        return None
+    return match.group(1)
+
+
+GIRDER_APPLICATION_ID = "5f4474d0e1d8c75dfc705482"
+
+RETRIABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+def createClientSession(concurrency=4):
+    """Return a :class:`aiohttp.ClientSession` shared by all requests sent to the packages server.
+
+    Connections are kept alive and reused, and at most ``concurrency`` connections are
+    opened simultaneously. Responses are requested gzip compressed.
+    """
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=concurrency),
+        headers={"Accept-Encoding": "gzip"},
+        timeout=aiohttp.ClientTimeout(total=300))
+
+
+class ResponseCache:
+    """On-disk cache of responses associated with their ``ETag`` and ``Last-Modified`` validators.
+
+    Each response is identified by its URL and query parameters, and stored in ``directory``
+    as a ``<key>.body`` file along with a ``<key>.json`` file holding the validators and the
+    SHA256 checksum of the body.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, url, params, extension):
+        key = hashlib.sha256(json.dumps([url, sorted((params or {}).items())]).encode()).hexdigest()
+        return os.path.join(self.directory, key + extension)
+
+    def _read(self, url, params):
+        try:
+            with open(self._path(url, params, '.json')) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+    def validatorHeaders(self, url, params):
+        """Return conditional request headers associated with the cached response."""
+        entry = self._read(url, params)
+        headers = {}
+        if not os.path.exists(self._path(url, params, '.body')):
+            return headers
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def load(self, url, params):
+        """Return the cached response body."""
+        with open(self._path(url, params, '.body'), 'rb') as fp:
+            return fp.read()
+
+    def store(self, url, params, body, etag=None, lastModified=None):
+        """Store the response body and its validators.
+
+        Return False if ``body`` is identical to the cached one, True otherwise.
+        """
+        sha256 = hashlib.sha256(body).hexdigest()
+        modified = self._read(url, params).get('sha256') != sha256
+        for extension, content in (
+            ('.body', body),
+            ('.json', json.dumps({'etag': etag, 'last_modified': lastModified, 'sha256': sha256}).encode()),
+        ):
+            path = self._path(url, params, extension)
+            with open(path + '.tmp', 'wb') as fp:
+                fp.write(content)
+            os.replace(path + '.tmp', path)
+        return modified
+
+
+async def fetchJSONIfModified(session, url, params=None, cache=None, retries=3, backoff=1.0):
+    """Send a GET request and return a tuple ``(document, modified)``.
+
+    ``document`` is the decoded JSON response.
+
+    If a ``cache`` is specified (see :class:`ResponseCache`), a conditional request is sent.
+    If the server answers with ``304 Not Modified`` or if the response body is identical
+    to the cached one, ``modified`` is False.
+
+    Requests failing because of a connection error, a timeout or one of the
+    :const:`RETRIABLE_STATUS_CODES` are retried up to ``retries`` times waiting
+    ``backoff * 2 ** attempt`` seconds between attempts.
+    """
+    headers = cache.validatorHeaders(url, params) if cache else {}
+    for attempt in range(retries + 1):
+        try:
+            async with session.get(url, params=params, headers=headers) as response:
+                if response.status == 304:
+                    return json.loads(cache.load(url, params)), False
+                response.raise_for_status()
+                body = await response.read()
+                modified = True
+                if cache:
+                    modified = cache.store(
+                        url, params, body, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+                return json.loads(body), modified
+        except aiohttp.ClientResponseError as exception:
+            if exception.status not in RETRIABLE_STATUS_CODES or attempt == retries:
+                raise
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt == retries:
+                raise
+        await asyncio.sleep(backoff * 2 ** attempt)
+
+
+async def fetchJSON(session, url, params=None, cache=None):
+    """Send a GET request and return the decoded JSON response.
+
+    See :func:`fetchJSONIfModified`.
+    """
+    return (await fetchJSONIfModified(session, url, params, cache))[0]
+
+
+def midasRecordsRequest():
+    """Return URL and parameters of the request listing all Midas records."""
     InfoURLMethod = 'midas.slicerpackages.get.packages'
+    return getServerAPIUrl(), {"productname": "Slicer", "method": InfoURLMethod}
+
 
-    infoURL = '{0}?productname=Slicer&method={1}'.format(getServerAPIUrl(), InfoURLMethod)
+def girderRecordPageRequest(offset, pageSize=100, sortById=False):
+    """Return URL and parameters of the request listing a page of Girder records sorted by decreasing
+    ``updated`` date, or by increasing ``_id`` if ``sortById`` is True."""
+    url = "{0}/app/{1}/package".format(getServerAPIUrl(), GIRDER_APPLICATION_ID)
+    if sortById:
+        return url, {"limit": pageSize, "offset": offset, "sort": "_id", "sortdir": 1}
+    return url, {"limit": pageSize, "offset": offset, "sort": "updated", "sortdir": -1}
 
-    fp = urllib.request.urlopen(infoURL)
-    info = fp.read()
-    fp.close()
 
-    return json.loads(info)['data']
+async def iterMidasRecordPages(session, cache=None):
+    """Yield the list of all Midas records as a single page.
 
+    The Midas API neither supports pagination nor streaming, the response is decoded at once.
+    """
+    yield (await fetchJSON(session, *midasRecordsRequest(), cache=cache))['data']
 
-def getGirderRecordsFromURL():
-    result = requests.get("{0}/app/5f4474d0e1d8c75dfc705482/package?limit=0".format(getServerAPIUrl()))
-    return result.json()
 
+async def iterGirderRecordPages(session, updatedSince=None, pageSize=100, concurrency=4, cache=None):
+    """Yield pages of Girder records sorted by decreasing ``updated`` date.
+
+    Pages are requested ``concurrency`` at a time. Pagination stops after the last page or
+    as soon as a record last updated before ``updatedSince`` is found.
+
+    If ``updatedSince`` is not specified, all records are yielded sorted by increasing ``_id``
+    instead: records created during the retrieval are listed last and updated ones keep their
+    position, so that the following pages are not shifted. Only records deleted during the
+    retrieval may still cause the following ones to be skipped, see :func:`getDeletedItemIdsFromURL`.
+
+    :param updatedSince: ISO 8601 date formatted as the ``updated`` field of Girder records.
+    """
+    sortById = updatedSince is None
+    offset = 0
+    while True:
+        pages = await asyncio.gather(*[
+            fetchJSON(session, *girderRecordPageRequest(offset + index * pageSize, pageSize, sortById), cache=cache)
+            for index in range(concurrency)
+        ])
+        offset += concurrency * pageSize
+        for page in pages:
+            records = [record for record in page if updatedSince is None or record["updated"] >= updatedSince]
+            if records:
+                yield records
+            if len(records) < pageSize:
+                return
+
+
+def iterRecordPages(session, updatedSince=None, concurrency=4, cache=None):
+    """Yield pages of records created or modified since ``updatedSince``.
+
+    Since the Midas API does not support sorting or pagination, all records are yielded
+    when using :const:`ServerAPI.Midas_v1`.
+
+    See :func:`iterMidasRecordPages` and :func:`iterGirderRecordPages`.
+    """
+    if getServerAPI() == ServerAPI.Midas_v1:
+        return iterMidasRecordPages(session, cache)
+    return iterGirderRecordPages(session, updatedSince, concurrency=concurrency, cache=cache)
 
-def getRecordsFromURL():
-    return {
-        ServerAPI.Midas_v1: getMidasRecordsFromURL,
-        ServerAPI.Girder_v1: getGirderRecordsFromURL,
-    }[getServerAPI()]()
+
+async def fetchReleases(session, cache=None):
+    """Return the list of Girder releases."""
+    url = "{0}/app/{1}/release".format(getServerAPIUrl(), GIRDER_APPLICATION_ID)
+    return await fetchJSON(session, url, {"limit": 0}, cache)
+
+
+async def fetchRecords(session, concurrency=4, cache=None):
+    """Return the list of all records."""
+    return [record async for page in iterRecordPages(session, concurrency=concurrency, cache=cache) for record in page]
+
+
+def iterAsyncGenerator(asyncGenerator):
+    """Yield items of ``asyncGenerator`` running a dedicated event loop while retrieving each item."""
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(asyncGenerator.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        loop.run_until_complete(asyncGenerator.aclose())
+        loop.close()
+
+
+def getLatestRecordUpdatedDate(cache=None):
+    """Return the most recent ``updated`` date of the Girder records, or None if there is no record.
+
+    The first page of records sorted by decreasing ``updated`` date is requested, any record
+    created or modified since would be listed first. If a ``cache`` is specified, the request is
+    conditional and the cached page is reused if unchanged (see :func:`fetchJSONIfModified`).
+
+    Whether records changed is up to the caller, e.g. by comparing with the date of the most
+    recent record stored: the cache may already hold a page whose records were never stored.
+    """
+    assert getServerAPI() == ServerAPI.Girder_v1
+
+    async def fetch():
+        async with createClientSession(1) as session:
+            return await fetchJSON(session, *girderRecordPageRequest(0), cache=cache)
+
+    page = asyncio.run(fetch())
+    return max((record["updated"] for record in page), default=None)
+
+
+def iterRecordsFromURL(updatedSince=None, concurrency=4, cache=None):
+    """Yield records created or modified since ``updatedSince``, or all records if not specified.
+
+    Records are requested using a single client session (see :func:`createClientSession`)
+    and pages of records are retrieved while the previous ones are consumed.
+
+    See :func:`iterRecordPages`.
+    """
+    async def iterRecords():
+        async with createClientSession(concurrency) as session:
+            async for page in iterRecordPages(session, updatedSince, concurrency, cache):
+                for record in page:
+                    yield record
+
+    return iterAsyncGenerator(iterRecords())
+
+
+async def isGirderItemDeleted(session, itemId):
+    """Return True if the packages server reports that the Girder item ``itemId`` does not exist."""
+    url = "{0}/item/{1}".format(getServerAPIUrl(), itemId)
+    try:
+        await fetchJSON(session, url)
+    except aiohttp.ClientResponseError as exception:
+        # Girder answers "400 Bad Request" for unknown item identifiers
+        if exception.status in (400, 404):
+            return True
+        raise
+    return False
+
+
+def getDeletedItemIdsFromURL(itemIds, concurrency=4):
+    """Return the identifiers of ``itemIds`` whose Girder item does not exist anymore.
+
+    Each item is looked up individually, ``concurrency`` at a time (see :func:`isGirderItemDeleted`).
+    """
+    assert getServerAPI() == ServerAPI.Girder_v1
+
+    async def fetch():
+        async with createClientSession(concurrency) as session:
+            return await asyncio.gather(*[isGirderItemDeleted(session, itemId) for itemId in itemIds])
+
+    return [itemId for itemId, deleted in zip(itemIds, asyncio.run(fetch())) if deleted]
+
+
+def getRecordsFromURL(cache=None):
+    """Return the list of all records.
+
+    See :func:`fetchRecords`.
+    """
+    async def fetch():
+        async with createClientSession() as session:
+            return await fetchRecords(session, cache=cache)
+
+    return asyncio.run(fetch())
+
+
+def getReleasesFromURL(cache=None):
+    """Return the list of Girder releases.
+
+    See :func:`fetchReleases`.
+    """
+    async def fetch():
+        async with createClientSession(1) as session:
+            return await fetchReleases(session, cache)
+
+    return asyncio.run(fetch())
+
+
+def chunked(iterable, size):
+    """Yield lists of at most ``size`` consecutive items from ``iterable``."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+RECORD_ENCODINGS = ('json', 'zlib', 'zstd')
+
+# Prefix identifying compressed record payloads. Plain JSON records are stored as text.
+RECORD_ENCODING_MARKERS = {
+    'zlib': b'zlib:',
+    'zstd': b'zstd:',
+}
+
+
+def encodeRecord(text, encoding='json'):
+    """Return record JSON ``text`` encoded for storage in the ``record`` column.
+
+    Supported encodings are listed in :const:`RECORD_ENCODINGS`. Compressed payloads are
+    returned as bytes prefixed by the marker associated with the encoding
+    (see :const:`RECORD_ENCODING_MARKERS`).
+
+    :raises ValueError: if the encoding is unknown or if ``zstd`` is requested but the
+     ``zstandard`` package is not installed.
+    """
+    if encoding == 'json':
+        return text
+    if encoding == 'zlib':
+        return RECORD_ENCODING_MARKERS['zlib'] + zlib.compress(text.encode(), 9)
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise ValueError("zstd record encoding requires the 'zstandard' package")
+        return RECORD_ENCODING_MARKERS['zstd'] + zstandard.ZstdCompressor(level=19).compress(text.encode())
+    raise ValueError(f"unsupported record encoding {encoding}")
+
+
+def decodeRecordText(value):
+    """Return record JSON text given a value read from the ``record`` column.
+
+    See :func:`encodeRecord`.
+    """
+    if isinstance(value, str):
+        return value
+    value = bytes(value)
+    if value.startswith(RECORD_ENCODING_MARKERS['zlib']):
+        return zlib.decompress(value[len(RECORD_ENCODING_MARKERS['zlib']):]).decode()
+    if value.startswith(RECORD_ENCODING_MARKERS['zstd']):
+        if zstandard is None:
+            raise ValueError("zstd record decoding requires the 'zstandard' package")
+        return zstandard.ZstdDecompressor().decompress(value[len(RECORD_ENCODING_MARKERS['zstd']):]).decode()
+    return value.decode()
+
+
+def decodeRecord(value):
+    """Return record dictionary given a value read from the ``record`` column.
+
+    See :func:`decodeRecordText`.
+    """
+    return json.loads(decodeRecordText(value))
 
 
 def openDb(database_filepath):
@@ -57,6 +535,126 @@ def openDb(database_filepath):
     return database_connection
 
 
+# inotify event masks (see ``man 7 inotify``)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+INOTIFY_EVENT_HEADER = struct.Struct('iIII')
+
+
+def _inotifyWatchDirectory(directory):
+    """Return inotify file descriptor watching ``directory`` for file changes.
+
+    Returns ``None`` if inotify is not available (e.g. non-Linux platform).
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _readInotifyEventNames(fd):
+    """Read pending inotify events from ``fd`` and return the associated file names."""
+    buffer = os.read(fd, 64 * 1024)
+    names = []
+    offset = 0
+    while offset < len(buffer):
+        _, _, _, length = INOTIFY_EVENT_HEADER.unpack_from(buffer, offset)
+        offset += INOTIFY_EVENT_HEADER.size
+        names.append(os.fsdecode(buffer[offset:offset + length].rstrip(b'\0')))
+        offset += length
+    return names
+
+
+class FileWatcher(threading.Thread):
+    """Background thread invoking ``callback`` after ``filepath`` has been modified.
+
+    On Linux, changes are detected using inotify by watching the parent directory, this
+    allows to also detect files being replaced and changes to the associated SQLite
+    ``-journal`` and ``-wal`` files. On other platforms, the file status is polled every
+    ``poll_interval`` seconds.
+
+    Changes are debounced: ``callback`` is only invoked once no change has been
+    observed for ``debounce`` seconds. A burst of writes results in a single call.
+
+    If ``notifyOnStart`` is True, ``callback`` is also invoked from the thread once the
+    file is watched, changes happening meanwhile are not missed. Exceptions raised by
+    ``callback`` are reported using ``logger``, the module logger by default.
+    """
+
+    def __init__(self, filepath, callback, debounce=2.0, poll_interval=5.0, notifyOnStart=False, logger=None):
+        super().__init__(name="FileWatcher({0})".format(os.path.basename(filepath)), daemon=True)
+        self.filepath = os.path.abspath(filepath)
+        self.callback = callback
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.notifyOnStart = notifyOnStart
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+
+    def run(self):
+        fd = _inotifyWatchDirectory(os.path.dirname(self.filepath))
+        lastState = self._fileState() if fd is None else None
+        if self.notifyOnStart:
+            self._notify()
+        if fd is None:
+            self._poll(lastState)
+        else:
+            self._watch(fd)
+
+    def _notify(self):
+        try:
+            self.callback()
+        except Exception:
+            self.logger.exception("FileWatcher: failed to process change of %s", self.filepath)
+
+    def _watch(self, fd):
+        basename = os.path.basename(self.filepath)
+        pending = False
+        while True:
+            readable, _, _ = select.select([fd], [], [], self.debounce if pending else None)
+            if readable:
+                if any(name.startswith(basename) for name in _readInotifyEventNames(fd)):
+                    pending = True
+            elif pending:
+                pending = False
+                self._notify()
+
+    def _fileState(self):
+        state = []
+        for suffix in ('', '-journal', '-wal'):
+            try:
+                stat = os.stat(self.filepath + suffix)
+            except FileNotFoundError:
+                state.append(None)
+                continue
+            state.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+        return state
+
+    def _poll(self, lastState):
+        pending = False
+        while True:
+            time.sleep(self.debounce if pending else self.poll_interval)
+            state = self._fileState()
+            if state != lastState:
+                lastState = state
+                pending = True
+            elif pending:
+                pending = False
+                self._notify()
+
+
 def progress(count, total, status=''):
     """Adapted from https://gist.github.com/vladignatyev/06860ec2040cb497f0f3
     """
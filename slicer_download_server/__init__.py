@@ -1,17 +1,28 @@
 import flask
-from flask import json
 
 import dateutil.parser
 import os
-import re
+import sqlite3
+import threading
 
 from itertools import groupby, islice
 
+try:
+    import uwsgidecorators
+except ImportError:
+    # only available when the application is served by uWSGI
+    uwsgidecorators = None
+
 from slicer_download import (
+    decodeRecord,
+    FileWatcher,
+    getRecordField,
     getServerAPI,
+    getVersion,
+    recordMatchesStability,
     ServerAPI,
     openDb,
-    toBool
+    STABILITY_CHOICES
 )
 
 SUPPORTED_OS_CHOICES = (
@@ -19,11 +30,6 @@ SUPPORTED_OS_CHOICES = (
     'win',
     'linux'
 )
-STABILITY_CHOICES = (
-    'release',
-    'nightly',
-    'any'
-)
 MODE_CHOICES = (
     'revision',
     'closest-revision',
@@ -159,43 +165,6 @@ def recordFindAllRequest():
     flask.abort(error_code)
 
 
-def getRecordField(record, key):
-    """Return the value of a specific field in the record.
-
-    Given a record and the field key, this function returns the value of the requested field.
-    Depending on the server API used, the key is mapped to a field in the database record.
-    See :func:`recordsMatchingAllOSAndStability` and :func:`getBestMatching`.
-
-    :param record: A dictionary with fields and values.
-    :param key: The field key.
-
-    :return: The value of the field in the record, or None if the field is not present.
-    """
-    if getServerAPI() == ServerAPI.Midas_v1:
-        if key == 'bitstream_id':
-            return record['bitstreams'][0]['bitstream_id']
-        else:
-            return record[key]
-
-    elif getServerAPI() == ServerAPI.Girder_v1:
-        if key == 'os':
-            return record['meta']['os']
-        elif key == 'revision':
-            return record['meta']['revision']
-        elif key == 'date_creation':
-            return record['meta']['build_date']
-        elif key == 'checkoutdate':
-            return None  # Not supported
-        elif key == 'release':
-            return record['meta'].get('release', '')
-        elif key == 'pre_release':
-            return record['meta'].get('pre_release', 'False')
-        elif key == 'submissiontype':
-            return 'release' if record['meta'].get('release') else 'nightly'
-        elif key == 'bitstream_id':
-            return record['_id']
-
-
 def getCleanedUpRecord(record):
     """Return a dictionary with, organized, cleaned up and standardized fields.
 
@@ -331,7 +300,7 @@ def recordMatching():
     """Return the best record that matches specific criteria.
 
     Given the parameters in the HTTP request (``flask.request``), this function gets revision records from
-    the database (see :func:`getRecordsFromDb`) and returns the best record that matches the provided criteria.
+    the database (see :func:`getRecordsSnapshot`) and returns the best record that matches the provided criteria.
 
     The criteria depend on the values of the `os`, `offset`, `stability`, and `mode`
     parameters passed in the HTTP request and are used to filter the database records using :func:`getBestMatching`.
@@ -342,7 +311,6 @@ def recordMatching():
             - An HTTP status code.
     """
     request = flask.request
-    revisionRecords = getRecordsFromDb()
 
     operatingSystem = request.args.get('os')  # may generate BadRequest if not present
     if operatingSystem not in SUPPORTED_OS_CHOICES:
@@ -366,7 +334,11 @@ def recordMatching():
     if stability not in STABILITY_CHOICES:
         return None, "bad stability {0}: should be one of {1}".format(stability, STABILITY_CHOICES), 400
 
-    record = getBestMatching(revisionRecords, operatingSystem, stability, modeName, value, offset)
+    versionPrefix = getMaterializedVersionPrefix(modeName, value, offset)
+    record = getLatestRecords([(operatingSystem, stability)], versionPrefix).get((operatingSystem, stability))
+    if record is None:
+        recordsByOS = getRecordsSnapshot()['recordsByOS']
+        record = getBestMatching(recordsByOS[operatingSystem], operatingSystem, stability, modeName, value, offset)
     cleaned = getCleanedUpRecord(record)
 
     if not cleaned:
@@ -379,7 +351,7 @@ def recordsMatchingAllOSAndStability():
     """Return all records that match the search criteria, for all OS and stability choices.
 
     Given the parameters in the HTTP request (``flask.request``), this function gets revision records from
-    the database (see :func:`getRecordsFromDb`) and returns all records that match the provided criteria.
+    the database (see :func:`getRecordsSnapshot`) and returns all records that match the provided criteria.
 
     The criteria depend on the values of the `os`, `offset`, `stability`, and `mode`
     parameters passed in the HTTP request. If any of these parameters are not specified, the default
@@ -396,7 +368,6 @@ def recordsMatchingAllOSAndStability():
     """
 
     request = flask.request
-    revisionRecords = getRecordsFromDb()
 
     offset_arg = request.args.get('offset', '0')
     try:
@@ -424,11 +395,20 @@ def recordsMatchingAllOSAndStability():
     else:
         stabilities = list(set(STABILITY_CHOICES) - set(['any']))
 
+    versionPrefix = getMaterializedVersionPrefix(modeName, value, offset)
+    latestRecords = getLatestRecords(
+        [(operatingSystem, stability) for operatingSystem in operatingSystems for stability in stabilities],
+        versionPrefix)
+
     results = {}
     for operatingSystem in operatingSystems:
         osResult = {}
         for stability in stabilities:
-            record = getBestMatching(revisionRecords, operatingSystem, stability, modeName, value, offset)
+            record = latestRecords.get((operatingSystem, stability))
+            if record is None:
+                recordsByOS = getRecordsSnapshot()['recordsByOS']
+                record = getBestMatching(
+                    recordsByOS[operatingSystem], operatingSystem, stability, modeName, value, offset)
             osResult[stability] = getCleanedUpRecord(record)
         results[operatingSystem] = osResult
 
@@ -541,63 +521,10 @@ def matchStability(stability):
     :param stability: stability to be matched. It should be one of the supported choices in :const:`STABILITY_CHOICES`.
 
     :return: a callable lambda function
-    """
-    if stability == 'nightly':
-        return lambda record: getRecordField(record, 'submissiontype') == 'nightly'
-    if stability == 'release':
-        return lambda record: getRecordField(record, 'release') != "" and not toBool(getRecordField(record, 'pre_release'))
-
-    return lambda record: True
-
-# regex patterns for extracting version information.
-# this looks ugly because we need to be able to accept versions like:
-# 4.5.0, 4.5.0-1, 4.5.0-rc2, 4.5.0-gamma, and so forth
-VersionWithDateRE = re.compile(r'^[A-z]+-([-\d.a-z]+)-(\d{4}-\d{2}-\d{2})')
-VersionRE = re.compile(r'^[A-z]+-([-\d.a-z]+)-(macosx|linux|win+)')
-VersionFullRE = re.compile(r'^([-\d.a-z]+)-(\d{4}-\d{2}-\d{2})')
-VersionXyzRE = re.compile(r'^(\d+\.\d+\.\d+)$')
-
-
-def getVersion(record):
-    """Extract version information from the given record.
-
-    If the ``release`` key is found, returns the associated value.
-
-    Otherwise, it returns the version extracted from the value associated
-    with the ``name`` key for :const:`ServerAPI.Midas_v1` or the ``meta.version``
-    key for :const:`ServerAPI.Girder_v1`.
-
-    For :const:`ServerAPI.Midas_v1`, version extraction is attempted using
-    first the :const:`VersionWithDateRE` pattern and then the :const:`VersionRE`
-    pattern.
-
-    For :const:`ServerAPI.Girder_v1`, version extraction is attempted using
-    first the :const:`VersionFullRE` pattern and then the :const:`VersionXyzRE`
-    pattern.
-
-    If the value associated with the selected key does not match any of the
-    regular expressions, it returns ``None``.
 
-    See :func:`getRecordField`.
+    See :func:`slicer_download.recordMatchesStability`.
     """
-    if getRecordField(record, 'release'):
-        return getRecordField(record, 'release')
-
-    match = None
-
-    if getServerAPI() == ServerAPI.Midas_v1:
-        match = VersionWithDateRE.match(record['name'])
-        if not match:
-            match = VersionRE.match(record['name'])
-
-    elif getServerAPI() == ServerAPI.Girder_v1:
-        match = VersionFullRE.match(record['meta']['version'])
-        if not match:
-            match = VersionXyzRE.match(record['meta']['version'])
-
-    if not match:
-        return None
-    return match.group(1)
+    return lambda record: recordMatchesStability(record, stability)
 
 
 def allPass(predlist):
@@ -707,6 +634,58 @@ def getBestMatching(revisionRecords, operatingSystem, stability, mode, modeArg,
     return matchingRecord
 
 
+def getMaterializedVersionPrefix(mode, modeArg, offset):
+    """Return the ``version_prefix`` of the ``_latest`` table rows answering the provided criteria.
+
+    The ``_latest`` table is maintained by ``slicer_getbuildinfo`` and associates the newest record
+    with each operating system, stability and version prefix.
+
+    It returns ``""`` for the default mode (see :func:`getMode`), the version for the `version`
+    mode, and None if the criteria can not be answered using the table (other modes or non-zero
+    offset).
+    """
+    if offset != 0:
+        return None
+    if mode == 'date' and modeArg == '9999-12-31':
+        return ''
+    if mode == 'version':
+        return modeArg
+    return None
+
+
+def getLatestRecords(operatingSystemAndStabilityPairs, versionPrefix):
+    """Return a dictionary mapping ``(operatingSystem, stability)`` pairs to the newest matching record
+    found in the ``_latest`` table.
+
+    Pairs without an associated row are omitted, the caller is expected to look for the record
+    using :func:`getBestMatching`. An empty dictionary is returned if ``versionPrefix`` is None
+    or if the table does not exist.
+
+    See :func:`getMaterializedVersionPrefix`.
+    """
+    if versionPrefix is None:
+        return {}
+    database_filepath = dbFilePath()
+    if not os.path.isfile(database_filepath):
+        return {}
+    database_connection = openDb(database_filepath)
+    latestRecords = {}
+    try:
+        for operatingSystem, stability in operatingSystemAndStabilityPairs:
+            row = database_connection.execute(
+                """select record from _latest join _ using(item_id)
+                where _latest.os=? and stability=? and version_prefix=?""",
+                (operatingSystem, stability, versionPrefix)).fetchone()
+            if row is not None:
+                latestRecords[(operatingSystem, stability)] = decodeRecord(row[0])
+    except sqlite3.OperationalError:
+        # Database created before the table was introduced
+        return {}
+    finally:
+        database_connection.close()
+    return latestRecords
+
+
 def dbFilePath():
     """Return database filepath.
 
@@ -746,21 +725,115 @@ def dbFilePath():
         return db_file
 
 
-def getRecordsFromDb():
-    """Return all records found in the database associated with :func:`dbFilePath()`.
+def loadRecordsSnapshot(database_filepath):
+    """Load all records found in ``database_filepath`` and return a snapshot.
 
-    List of records are cached using an application configuration entry identified
-    by ``_CACHED_RECORDS`` key.
+    The snapshot is a dictionary with the following keys:
+
+    * ``records``: list of records ordered by descending revision and build date, compressed
+      payloads are decoded using :func:`slicer_download.decodeRecord`.
+    * ``recordsByOS``: dictionary mapping each of :const:`SUPPORTED_OS_CHOICES` to the
+      list of associated records, preserving the order.
 
     See also :func:`openDb`.
     """
+    if not os.path.isfile(database_filepath):
+        raise IOError(2, 'Database file %s does not exist', database_filepath)
+    database_connection = openDb(database_filepath)
+    cursor = database_connection.cursor()
+    cursor.execute('select record from _ order by revision desc,build_date desc')
+    records = [decodeRecord(record[0]) for record in cursor.fetchall()]
+    database_connection.close()
+
+    recordsByOS = {operatingSystem: [] for operatingSystem in SUPPORTED_OS_CHOICES}
+    for record in records:
+        recordsByOS.setdefault(getRecordField(record, 'os'), []).append(record)
+
+    return {'records': records, 'recordsByOS': recordsByOS}
+
+
+_recordsWatcher = None
+_recordsWatcherLock = threading.Lock()
+
+
+def reloadRecordsSnapshot(loaded=None):
+    """Reload the records snapshot cached using the ``_CACHED_RECORDS_SNAPSHOT`` application
+    configuration entry.
+
+    This function is called from the background thread started in :func:`startRecordsWatcher`,
+    ``loaded`` is set once the snapshot is loaded or failed to load.
+    """
     try:
-        records = flask.current_app.config["_CACHED_RECORDS"]
-    except KeyError:
-        records = None
+        database_filepath = dbFilePath()
+        app.config["_CACHED_RECORDS_SNAPSHOT"] = loadRecordsSnapshot(database_filepath)
+        app.logger.info("reloaded records from %s" % database_filepath)
+    finally:
+        if loaded is not None:
+            loaded.set()
+
+
+def startRecordsWatcher():
+    """Start background thread loading the records snapshot, then reloading it when the
+    database associated with :func:`dbFilePath()` is modified.
+
+    Return a :class:`threading.Event` set once the snapshot is first loaded.
+
+    Since uWSGI workers are forked after the application is loaded, the watcher is started
+    in each worker after the fork, or lazily otherwise, and restarted if the current process
+    is not the one having started it. A lock ensures that a single watcher is started when
+    requests are served by several threads.
+
+    The ``DB_WATCH_DEBOUNCE`` configuration entry sets the number of seconds without changes
+    to wait for before reloading the records.
+
+    See :class:`slicer_download.FileWatcher`.
+    """
+    global _recordsWatcher
+    with _recordsWatcherLock:
+        if _recordsWatcher is not None and _recordsWatcher[0] == os.getpid():
+            return _recordsWatcher[2]
+        loaded = threading.Event()
+        watcher = FileWatcher(
+            dbFilePath(), lambda: reloadRecordsSnapshot(loaded),
+            debounce=float(app.config.get('DB_WATCH_DEBOUNCE', 2.0)), notifyOnStart=True, logger=app.logger)
+        watcher.start()
+        _recordsWatcher = (os.getpid(), watcher, loaded)
+        return loaded
+
+
+if uwsgidecorators is not None and app.config.get('DB_WATCH', False):
+    uwsgidecorators.postfork(startRecordsWatcher)
+
+
+def getRecordsSnapshot():
+    """Return records snapshot associated with the database returned by :func:`dbFilePath()`.
+
+    The snapshot is cached using an application configuration entry identified
+    by ``_CACHED_RECORDS_SNAPSHOT`` key.
+
+    If the ``DB_WATCH`` configuration entry is set to True, the snapshot is loaded and
+    reloaded in the background after the database is updated (see :func:`startRecordsWatcher`).
+    Otherwise, the snapshot is reloaded if the number of records found in the database
+    has changed.
+
+    See :func:`loadRecordsSnapshot`.
+    """
+    snapshot = app.config.get("_CACHED_RECORDS_SNAPSHOT")
 
     database_filepath = dbFilePath()
     app.logger.info("database_filepath: %s" % database_filepath)
+
+    if app.config.get('DB_WATCH', False):
+        loaded = startRecordsWatcher()
+        if snapshot is None:
+            loaded.wait()
+            snapshot = app.config.get("_CACHED_RECORDS_SNAPSHOT")
+        if snapshot is None:
+            # the watcher failed to load the snapshot, report the error
+            snapshot = loadRecordsSnapshot(database_filepath)
+            app.config["_CACHED_RECORDS_SNAPSHOT"] = snapshot
+        return snapshot
+
     if not os.path.isfile(database_filepath):
         raise IOError(2, 'Database file %s does not exist', database_filepath)
     database_connection = openDb(database_filepath)
@@ -770,15 +843,22 @@ def getRecordsFromDb():
     cursor.execute('select count(1) from _')
     count = int(cursor.fetchone()[0])
 
+    database_connection.close()
+
     # load db if needed or count has changed
-    if records is None or count != len(records):
-        cursor.execute('select record from _ order by revision desc,build_date desc')
-        records = [json.loads(record[0]) for record in cursor.fetchall()]
-        flask.current_app.config["_CACHED_RECORDS"] = records
+    if snapshot is None or count != len(snapshot['records']):
+        snapshot = loadRecordsSnapshot(database_filepath)
+        app.config["_CACHED_RECORDS_SNAPSHOT"] = snapshot
 
-    database_connection.close()
+    return snapshot
 
-    return records
+
+def getRecordsFromDb():
+    """Return all records found in the database associated with :func:`dbFilePath()`.
+
+    See :func:`getRecordsSnapshot`.
+    """
+    return getRecordsSnapshot()['records']
 
 
 @app.teardown_appcontext